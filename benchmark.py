@@ -0,0 +1,952 @@
+import argparse
+import compileall
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import http.server
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import catalog
+import county_store
+import cross_section
+import data_setup
+import export
+import final_project
+import search
+import series_store
+
+
+def write_county_fixture(path, rows, part='A'):
+    # Quoted names with commas exercise the csv parser like the real file.
+    # Another part renames every county, keeping its fips.
+    counties = 3000
+    start = datetime.date(2020, 1, 21)
+    with open(path, 'w', newline='') as fixture:
+        writer = csv.writer(fixture)
+        writer.writerow(['date', 'county', 'state', 'fips', 'cases', 'deaths'])
+        for i in range(rows):
+            day, county = divmod(i, counties)
+            writer.writerow([(start + datetime.timedelta(days=day)).isoformat(),
+                             'County ' + str(county) + ', Part ' + part,
+                             'State ' + str(county // 60),
+                             '%05d' % (1001 + county),
+                             day * (county % 50 + 1),
+                             '' if county % 97 == 0 else day // 10])
+
+
+def write_fixtures(directory, days, counties, states=50):
+    # Synthetic stand-ins for the three NYT CSVs and the three Census
+    # responses, in the same formats. County i belongs to state i % states.
+    start = datetime.date(2020, 1, 21)
+    state_fips = ['%02d' % (x + 1) for x in range(states)]
+    county_fips = [state_fips[x % states] + '%03d' % (x // states + 1)
+                   for x in range(counties)]
+    with open(os.path.join(directory, 'us.csv'), 'w', newline='') as us, \
+            open(os.path.join(directory, 'us-states.csv'), 'w',
+                 newline='') as state, \
+            open(os.path.join(directory, 'us-counties.csv'), 'w',
+                 newline='') as county:
+        us_writer = csv.writer(us)
+        state_writer = csv.writer(state)
+        county_writer = csv.writer(county)
+        us_writer.writerow(['date', 'cases', 'deaths'])
+        state_writer.writerow(['date', 'state', 'fips', 'cases', 'deaths'])
+        county_writer.writerow(['date', 'county', 'state', 'fips', 'cases',
+                                'deaths'])
+        for day in range(days):
+            date = (start + datetime.timedelta(days=day)).isoformat()
+            state_totals = {x: [0, 0] for x in state_fips}
+            for i, fips in enumerate(county_fips):
+                cases = day * (i % 50 + 1)
+                deaths = cases // 60
+                county_writer.writerow([date, 'County ' + str(i) + ', Part A',
+                                        'State ' + fips[:2], fips, cases,
+                                        deaths])
+                state_totals[fips[:2]][0] += cases
+                state_totals[fips[:2]][1] += deaths
+            for fips, (cases, deaths) in state_totals.items():
+                state_writer.writerow([date, 'State ' + fips, fips, cases,
+                                       deaths])
+            us_writer.writerow([date,
+                                sum(x[0] for x in state_totals.values()),
+                                sum(x[1] for x in state_totals.values())])
+
+    census = {
+        'us': [['POP', 'DENSITY', 'us'], ['328239523', '92.9', '1']],
+        'state': [['POP', 'DENSITY', 'NAME', 'state']] +
+                 [[str(100000 * (i + 1)), str(10.5 * (i + 1)),
+                   'State ' + x, x] for i, x in enumerate(state_fips)],
+        'county': [['POP', 'DENSITY', 'NAME', 'state', 'county']] +
+                  [[str(1000 * (i % 300 + 1)), str(i % 70 + 0.5),
+                    'County ' + str(i) + ', State ' + x[:2], x[:2], x[2:]]
+                   for i, x in enumerate(county_fips)],
+    }
+    for level, rows in census.items():
+        with open(os.path.join(directory, 'census_' + level + '.json'),
+                  'w') as census_file:
+            # One row per line, as the Census API sends it.
+            census_file.write('[' + ',\n'.join(json.dumps(x) for x in rows)
+                              + ']')
+
+    # County shapes: a grid of half degree squares, 60 to a row.
+    features = list()
+    for i, fips in enumerate(county_fips):
+        x, y = -125 + (i % 60) * 0.5, 25 + (i // 60) * 0.5
+        ring = [[x, y], [x + 0.5, y], [x + 0.5, y + 0.5], [x, y + 0.5],
+                [x, y]]
+        features.append({'type': 'Feature', 'id': fips,
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [ring]}})
+    with open(os.path.join(directory, 'geojson-counties-fips.json'),
+              'w') as geo_file:
+        json.dump({'type': 'FeatureCollection', 'features': features},
+                  geo_file)
+
+
+@contextlib.contextmanager
+def serve_fixtures(directory, latency=0.0, failures=0):
+    # Serves write_fixtures() output in place of the NYT and Census hosts.
+    # Every request waits `latency` seconds, and the first `failures`
+    # requests for each path get a 503.
+    failed = dict()
+    lock = threading.Lock()
+
+    class FixtureHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            time.sleep(latency)
+            with lock:
+                failed[self.path] = failed.get(self.path, 0) + 1
+                fail = failed[self.path] <= failures
+            if fail:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if url.path.endswith('/population'):
+                level = urllib.parse.parse_qs(url.query)['for'][0]
+                name = 'census_' + level.split(':')[0] + '.json'
+            else:
+                name = os.path.basename(url.path)
+            with open(os.path.join(directory, name), 'rb') as body:
+                data = body.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def fixture_data_setup(base_url, directory):
+    # Points data_setup at a fixture server and a scratch database.
+    saved = (data_setup.NYT_COVID19_BASE, data_setup.CENSUS_POP_BASE,
+             data_setup.COUNTY_GEOJSON_URL, data_setup.PROJECT_DATABASE_NAME,
+             os.getcwd())
+    data_setup.NYT_COVID19_BASE = base_url
+    data_setup.CENSUS_POP_BASE = base_url + 'population'
+    data_setup.COUNTY_GEOJSON_URL = base_url + 'geojson-counties-fips.json'
+    data_setup.PROJECT_DATABASE_NAME = os.path.join(directory,
+                                                    'project_data.sqlite')
+    os.chdir(directory)  # The series store is written to the cwd.
+    try:
+        yield
+    finally:
+        (data_setup.NYT_COVID19_BASE, data_setup.CENSUS_POP_BASE,
+         data_setup.COUNTY_GEOJSON_URL,
+         data_setup.PROJECT_DATABASE_NAME) = saved[:4]
+        os.chdir(saved[4])
+
+
+def bench_fetch(latency, failures):
+    # Full main_data_setup against a slow, flaky local server, with the
+    # six downloads run one at a time and then all at once.
+    data_setup.FETCH_BACKOFF = 0.05
+    with tempfile.TemporaryDirectory() as fixtures:
+        write_fixtures(fixtures, 30, 300)
+        for workers in [1, data_setup.FETCH_WORKERS]:
+            data_setup.FETCH_WORKERS = workers
+            with serve_fixtures(fixtures, latency, failures) as base_url, \
+                    tempfile.TemporaryDirectory() as scratch, \
+                    fixture_data_setup(base_url, scratch):
+                start = time.perf_counter()
+                data_setup.main_data_setup()
+                elapsed = time.perf_counter() - start
+            print('fetch workers=%d latency_s=%.2f failures=%d '
+                  'seconds=%.2f' % (workers, latency, failures, elapsed))
+
+
+def bench_ingest(rows_list):
+    # The county file's load as data_setup runs it: rows streamed through
+    # county_store.compact_rows into the compact tables, then swapped in.
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in rows_list:
+            fixture = os.path.join(tmp, 'us-counties.csv')
+            write_county_fixture(fixture, rows)
+            conn = sqlite3.connect(os.path.join(tmp, str(rows) + '.sqlite'))
+            cur = conn.cursor()
+            data_setup.get_table_timings(conn, cur)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            data_setup.load_county_file(conn, cur, fixture)
+            conn.commit()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            conn.close()
+
+            print('ingest rows=%d seconds=%.2f rows/sec=%.0f '
+                  'peak_traced_mb=%.2f max_rss_mb=%.1f'
+                  % (rows, elapsed, rows / elapsed, peak / 2**20,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_bulk(rows_list):
+    # A full county load (staging table, swap, indexes, ANALYZE) into a
+    # WAL database, with the default settings and in bulk_load mode.
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, 'us-counties.csv')
+        for rows in rows_list:
+            write_county_fixture(fixture, rows)
+            for bulk in [False, True]:
+                conn = sqlite3.connect(os.path.join(tmp, 'bulk.sqlite'))
+                cur = conn.cursor()
+                cur.execute("PRAGMA journal_mode=WAL;")
+                data_setup.get_table_timings(conn, cur)
+                start = time.perf_counter()
+                with (data_setup.bulk_load(cur) if bulk
+                      else contextlib.nullcontext()):
+                    data_setup.load_covid_file(conn, cur, 'county', fixture)
+                    conn.commit()
+                elapsed = time.perf_counter() - start
+                conn.close()
+                os.remove(os.path.join(tmp, 'bulk.sqlite'))
+                print('bulk rows=%d mode=%s seconds=%.2f rows/sec=%.0f'
+                      % (rows, 'bulk' if bulk else 'default', elapsed,
+                         rows / elapsed))
+
+
+def bench_revisions(rows):
+    # A full county load, then the upsert of a revised file in which every
+    # county has been renamed, as the NYT does now and then. Fails unless
+    # the county view still has one row per (fips, date), under the new
+    # names.
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, 'us-counties.csv')
+        conn = sqlite3.connect(os.path.join(tmp, 'revisions.sqlite'))
+        cur = conn.cursor()
+        data_setup.get_table_timings(conn, cur)
+        write_county_fixture(fixture, rows)
+        data_setup.load_county_file(conn, cur, fixture)
+        conn.commit()
+        write_county_fixture(fixture, rows, 'B')
+        start = time.perf_counter()
+        with open(fixture, newline='') as csv_stream:
+            data_setup.upsert_county_csv(conn, cur, csv_stream)
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        cmd = ("SELECT count(*) FROM (SELECT fips, date FROM county " +
+               "GROUP BY fips, date HAVING count(*)>1);")
+        duplicates = cur.execute(cmd).fetchone()[0]
+        cmd = "SELECT count(*) FROM county WHERE county LIKE '%Part A';"
+        old_names = cur.execute(cmd).fetchone()[0]
+        total = cur.execute("SELECT count(*) FROM county;").fetchone()[0]
+        conn.close()
+    print('revisions rows=%d seconds=%.2f duplicates=%d old_names=%d'
+          % (total, elapsed, duplicates, old_names))
+    if duplicates or old_names or total != rows:
+        sys.exit('revisions: renamed counties were not replaced')
+
+
+# The county table as it was before county_store: the NYT's text columns
+# with a rowid, and these indexes.
+LEGACY_COUNTY_INDEXES = ['fips,date', 'date', 'substr(fips,1,2),fips']
+
+
+def load_legacy_county(conn, cur, fixture):
+    with open(fixture, newline='') as csv_stream:
+        header = data_setup.store_covid_csv(conn, cur, 'county', csv_stream)
+    for i, columns in enumerate(LEGACY_COUNTY_INDEXES):
+        cur.execute('CREATE INDEX legacy_county_' + str(i) +
+                    ' ON county (' + columns + ');')
+    data_setup.create_covid_key_index(cur, 'county', header)
+    cur.execute('ANALYZE county;')
+    conn.commit()
+
+
+def bench_storage(rows_list, lookups):
+    # Database size, load time and read times of the county rows in the
+    # old text layout and in county_store's compact one. Reads go through
+    # a new connection, so sqlite's own cache starts empty (the OS's
+    # doesn't).
+    with tempfile.TemporaryDirectory() as tmp:
+        fixture = os.path.join(tmp, 'us-counties.csv')
+        for rows in rows_list:
+            write_county_fixture(fixture, rows)
+            fips_list = ['%05d' % (1001 + x % 3000) for x in range(lookups)]
+            for layout in ['text', 'compact']:
+                path = os.path.join(tmp, layout + '.sqlite')
+                conn = sqlite3.connect(path)
+                cur = conn.cursor()
+                data_setup.get_table_timings(conn, cur)
+                start = time.perf_counter()
+                if layout == 'text':
+                    load_legacy_county(conn, cur, fixture)
+                else:
+                    data_setup.load_covid_file(conn, cur, 'county', fixture)
+                    conn.commit()
+                load_seconds = time.perf_counter() - start
+                conn.close()
+                size = os.path.getsize(path)
+
+                conn = sqlite3.connect(path)
+                start = time.perf_counter()
+                conn.execute('SELECT sum(cases), sum(deaths), count(*) '
+                             'FROM county;').fetchone()
+                scan_seconds = time.perf_counter() - start
+                # Every row, as series_store reads them to build the store.
+                start = time.perf_counter()
+                if layout == 'text':
+                    conn.execute("SELECT fips, date, cases, deaths FROM "
+                                 "county WHERE fips<>'';").fetchall()
+                else:
+                    conn.execute(county_store.SERIES_QUERY).fetchall()
+                read_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                for fips in fips_list:
+                    conn.execute('SELECT date, cases, deaths FROM county '
+                                 'WHERE fips=? ORDER BY date;',
+                                 (fips,)).fetchall()
+                series_us = (time.perf_counter() - start) / lookups * 1e6
+                conn.close()
+                os.remove(path)
+                print('storage rows=%d layout=%s mb=%.1f bytes/row=%.1f '
+                      'load_seconds=%.2f scan_seconds=%.3f '
+                      'read_seconds=%.3f series_us=%.1f'
+                      % (rows, layout, size / 2**20, size / rows,
+                         load_seconds, scan_seconds, read_seconds,
+                         series_us))
+
+
+def timed_get(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def bench_load(base_url, paths, requests_per_path, concurrency):
+    # Run against a threaded or multi-worker server, once on the old code
+    # and once on the new, to compare latency under concurrent load.
+    urls = [base_url.rstrip('/') + path for path in paths] * requests_per_path
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(timed_get, urls))
+    elapsed = time.perf_counter() - start
+    cuts = statistics.quantiles(latencies, n=100)
+    print('load requests=%d concurrency=%d req/sec=%.1f p50_ms=%.1f '
+          'p99_ms=%.1f' % (len(urls), concurrency, len(urls) / elapsed,
+                           cuts[49] * 1000, cuts[98] * 1000))
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def bench_workers(worker_counts, paths, requests_per_path, concurrency,
+                  port=8099):
+    # Requests per second through gunicorn (wsgi.py, preloaded) as the
+    # number of worker processes grows. Run from the directory holding
+    # the database.
+    base_url = 'http://127.0.0.1:' + str(port)
+    for workers in worker_counts:
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--preload',
+             '--workers', str(workers), '--bind', '127.0.0.1:' + str(port),
+             '--log-level', 'warning', 'wsgi:app'])
+        try:
+            wait_for_server(base_url + paths[0])
+            print('workers=%d' % workers, end=' ', flush=True)
+            bench_load(base_url, paths, requests_per_path, concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_wire(base_url, paths, requests_per_path):
+    # Bytes on the wire and server time for each path, accepting compressed
+    # responses like a browser. Each request gets its own query string so
+    # that it misses the page cache and the time is the full render.
+    for path in paths:
+        latencies = list()
+        for i in range(requests_per_path):
+            url = (base_url.rstrip('/') + path + ('&' if '?' in path else '?')
+                   + 'nocache=' + str(time.time_ns()))
+            get = urllib.request.Request(
+                url, headers={'Accept-Encoding': 'br, gzip'})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(get) as response:
+                    body = response.read()  # urllib leaves it compressed.
+                    encoding = response.headers.get('Content-Encoding',
+                                                    'none')
+            except urllib.error.HTTPError as error:
+                status = error.code  # e.g. API routes on an older server.
+                break
+            latencies.append(time.perf_counter() - start)
+        if not latencies:
+            print('wire path=%s status=%d' % (path, status))
+            continue
+        print('wire path=%s bytes=%d encoding=%s median_ms=%.1f'
+              % (path, len(body), encoding,
+                 statistics.median(latencies) * 1000))
+
+
+def bench_series(level, lookups):
+    # Compares the old per-request path (sqlite3.Row objects turned into
+    # Python lists) with slicing the memory-mapped columnar store.
+    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    version = data_setup.get_data_version(cur)
+    if level == 'us':
+        fips_list = ['']
+    else:
+        cmd = 'SELECT DISTINCT fips FROM ' + level + " WHERE fips<>'';"
+        fips_list = [x[0] for x in cur.execute(cmd).fetchall()]
+    fips_list = (fips_list * lookups)[:lookups]
+
+    start = time.perf_counter()
+    for fips in fips_list:
+        if level == 'us':
+            rows = cur.execute('SELECT date,cases,deaths FROM us;').fetchall()
+        else:
+            cmd = 'SELECT date,cases,deaths FROM ' + level + ' WHERE fips=?;'
+            rows = cur.execute(cmd, tuple([fips])).fetchall()
+        dates = [x['date'] for x in rows]
+        cases = [x['cases'] for x in rows]
+        deaths = [x['deaths'] for x in rows]
+    sqlite_us = (time.perf_counter() - start) / lookups * 1e6
+
+    store = series_store.SeriesStore()
+    if store.get(level, fips_list[0], version) is None:
+        print('series store is not built for the current data version')
+        return
+    start = time.perf_counter()
+    for fips in fips_list:
+        data = store.get(level, fips, version)
+    store_us = (time.perf_counter() - start) / lookups * 1e6
+    conn.close()
+
+    print('series level=%s lookups=%d sqlite_us=%.1f store_us=%.1f '
+          'speedup=%.0fx' % (level, lookups, sqlite_us, store_us,
+                             sqlite_us / store_us))
+
+
+def bench_search(lookups):
+    # Building the name index from the catalog, and autocomplete queries:
+    # the first 1 to 4 letters of every name in turn, so the short and
+    # broad prefixes are timed along with the narrow ones.
+    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
+    places = catalog.load_catalog(conn.cursor())
+    conn.close()
+    start = time.perf_counter()
+    index = search.PlaceIndex(places)
+    build_ms = (time.perf_counter() - start) * 1000
+    queries = [x[3][:y] for x in index.places for y in range(1, 5)]
+    queries = (queries * lookups)[:lookups]
+
+    latencies = list()
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - start)
+    cuts = statistics.quantiles(latencies, n=100)
+    print('search places=%d keys=%d build_ms=%.1f lookups=%d p50_us=%.1f '
+          'p99_us=%.1f' % (len(index.places),
+                           len(index.lists[(None, None)][0]), build_ms,
+                           lookups, cuts[49] * 1e6, cuts[98] * 1e6))
+
+
+def route_queries(cursor):
+    # {name: (sql, parameters)} for every sqlite lookup a route makes for a
+    # place, date or ranking, with a state, county and date from the data.
+    # Left out are the reads meant to take a whole table: the catalog at
+    # startup, the one-row data_version, the us series, and exports of a
+    # whole level.
+    places = catalog.load_catalog(cursor)
+    state = places['states'][0]
+    county = places['counties'][state][0]
+    date = places['dates']['county'][-1]
+    queries = {
+        'us_date': (final_project.date_query('us'), ('', date)),
+        'state_date': (final_project.date_query('state'), (state, date)),
+        'county_date': (final_project.date_query('county'), (county, date)),
+        'county_totals': (final_project.county_totals_query(), (state, date)),
+        'series_state': (series_store.batch_query('state', 2),
+                         (state, state)),
+        'series_county': (series_store.batch_query('county', 2),
+                          (county, county)),
+    }
+    for level in ['state', 'county']:
+        queries['cross_section_' + level] = cross_section.date_query(level,
+                                                                     date)
+        queries['export_' + level] = export.export_query(level, state, date,
+                                                         date)
+    for column in final_project.COMPARE_NAMES:
+        queries['rank_state_' + column] = (
+            final_project.rank_query(column, 'desc'), (5,))
+        queries['rank_county_' + column] = (
+            final_project.rank_query(column, 'desc', state), (state, 5))
+    return queries
+
+
+def bench_plans():
+    # EXPLAIN QUERY PLAN of each of route_queries; any full SCAN of a table
+    # fails, since it grows with the data rather than the response.
+    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
+    cur = conn.cursor()
+    queries = route_queries(cur)
+    scans = list()
+    for name, (query, parameters) in queries.items():
+        plan = [x[3] for x in cur.execute('EXPLAIN QUERY PLAN ' + query,
+                                          parameters).fetchall()]
+        print('plans %s: %s' % (name, '; '.join(plan)))
+        if any(x.startswith('SCAN ') for x in plan):
+            scans.append(name)
+    conn.close()
+    if scans:
+        sys.exit('plans with a full scan: ' + ', '.join(scans))
+    print('plans no full scans in %d route queries' % len(queries))
+
+
+def suite_requests(days, counties, states):
+    # One request per endpoint of the app, as {name: (method, path, form)},
+    # using places and a date that exist in write_fixtures() output.
+    date = (datetime.date(2020, 1, 21) +
+            datetime.timedelta(days=days // 2)).isoformat()
+    state = '01'
+    county = state + '001'
+    return {
+        'index': ('GET', '/', None),
+        'us': ('GET', '/us', None),
+        'us_date': ('GET', '/us/us_date_' + date, None),
+        'us_graph': ('GET', '/us/us_graph_both', None),
+        'state': ('GET', '/state', None),
+        'state_date': ('GET', '/state/state_date/' + state + '/' + date,
+                       None),
+        'state_graph': ('GET', '/state/state_compare/cases_desc/cases?count=10',
+                        None),
+        'county': ('GET', '/county/' + state, None),
+        'county_date': ('GET', '/county/county_details/' + state + '/' +
+                        county + '/' + date, None),
+        'county_graph': ('GET', '/county/county_compare/' + state +
+                         '/pop_desc/deaths?count=10', None),
+        'api_series_us': ('GET', '/api/v1/series/us', None),
+        'api_series_county': ('GET', '/api/v1/series/county/' + county +
+                              '?columns=cases,avg_cases&max_points=500',
+                              None),
+        'api_series_weekly': ('GET', '/api/v1/series/state/' + state +
+                              '?resolution=weekly&start=' + date, None),
+        'api_compare_state': ('GET', '/api/v1/compare/state/cases_desc/cases'
+                              '?count=50', None),
+        'api_compare_county': ('GET', '/api/v1/compare/county/' + state +
+                               '/cases_per_100k_desc/deaths?count=25', None),
+        'api_cross_section_state': ('GET', '/api/v1/cross_section/state/' +
+                                    date + '?columns=cases,cfr', None),
+        'api_cross_section_county': ('GET', '/api/v1/cross_section/county/' +
+                                     date + '?columns=avg_cases_per_100k',
+                                     None),
+        'api_export_county': ('GET', '/api/v1/export/county.csv?state=' +
+                              state + '&start=' + date, None),
+        'api_export_state': ('GET', '/api/v1/export/state.ndjson', None),
+        'api_search_county': ('GET', '/api/v1/search?q=county+1&level=county',
+                              None),
+        'api_search_state': ('GET', '/api/v1/search?q=st&state=' + state,
+                             None),
+        'map': ('GET', '/map', None),
+        'map_county': ('GET', '/map/county/' + date + '/cases_per_100k',
+                       None),
+        'geo_county': ('GET', '/geo/county.json', None),
+        'plotly_bundle': ('GET', '/plotly-' + final_project.plotly.__version__
+                          + '.min.js', None),
+        'static': ('GET', '/static/charts.js', None),
+        'cache_stats': ('GET', '/cache_stats', None),
+        'metrics': ('GET', '/metrics', None),
+        'us_date_results': ('POST', '/us/date_results', {'date': date}),
+        'us_graph_results': ('POST', '/us/graph_results', {'graph': 'both'}),
+        'state_date_results': ('POST', '/state/date_results',
+                               {'state': state, 'date': date}),
+        'state_graph_results': ('POST', '/state/graph_results',
+                                {'comparison': 'cases desc',
+                                 'yaxis': 'cases', 'count': '10'}),
+        'county_state_results': ('POST', '/county/state_selector',
+                                 {'state': state}),
+        'county_date_results': ('POST', '/county/date_results/' + state,
+                                {'county': county, 'date': date}),
+        'county_name_results': ('POST', '/county/date_results/' + state,
+                                {'county': '', 'county_name': 'county 0',
+                                 'date': date}),
+        'county_graph_results': ('POST', '/county/county_compare/' + state,
+                                 {'comparison': 'cases desc',
+                                  'yaxis': 'cases', 'count': '10'}),
+        'map_results': ('POST', '/map/results',
+                        {'level': 'state', 'date': date, 'metric': 'cases'}),
+    }
+
+
+def percentile_ms(latencies, percent):
+    if len(latencies) < 2:
+        return latencies[0] * 1000
+    return statistics.quantiles(latencies, n=100)[percent - 1] * 1000
+
+
+def bench_routes(app, requests, requests_per_route):
+    # After one untimed request, each GET is made with a fresh query
+    # string so that it misses the page cache and times the full render,
+    # then as many times again as the first was, to time cache hits.
+    client = app.test_client()
+    results = dict()
+    for name, (method, path, form) in requests.items():
+        client.open(path, method=method, data=form)  # Compile templates.
+        latencies = list()
+        start = time.perf_counter()
+        for i in range(requests_per_route):
+            url = path
+            if method == 'GET':
+                url += ('&' if '?' in path else '?') + 'nocache=' + str(i)
+            request_start = time.perf_counter()
+            response = client.open(url, method=method, data=form)
+            response.get_data()
+            latencies.append(time.perf_counter() - request_start)
+        elapsed = time.perf_counter() - start
+        result = {'status': response.status_code,
+                  'bytes': len(response.get_data()),
+                  'req_per_sec': round(requests_per_route / elapsed, 1),
+                  'p50_ms': round(percentile_ms(latencies, 50), 3),
+                  'p90_ms': round(percentile_ms(latencies, 90), 3),
+                  'p99_ms': round(percentile_ms(latencies, 99), 3)}
+        if method == 'GET':
+            hits = list()
+            for i in range(requests_per_route):
+                start = time.perf_counter()
+                client.get(path).get_data()
+                hits.append(time.perf_counter() - start)
+            result['cached_p50_ms'] = round(percentile_ms(hits, 50), 3)
+        results[name] = result
+        print('route %-22s status=%d p50_ms=%.2f p99_ms=%.2f req/sec=%.0f'
+              % (name, result['status'], result['p50_ms'], result['p99_ms'],
+                 result['req_per_sec']))
+    return results
+
+
+STARTUP_SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+import final_project
+imported = time.perf_counter()
+numpy = 'numpy' in sys.modules
+client = final_project.app.test_client()
+client.get(sys.argv[2])
+first = time.perf_counter()
+served = time.time()
+client.get(sys.argv[3])
+chart = time.perf_counter()
+print((served - float(sys.argv[1])) * 1000, (imported - start) * 1000,
+      (first - imported) * 1000, (chart - first) * 1000, numpy)
+'''
+STARTUP_IMPORTS = 12  # Slowest top-level imports reported.
+
+
+def bench_startup(directory, runs, paths=('/', '/api/v1/series/us')):
+    # A fresh interpreter serving a snapshot (data_setup.py --snapshot)
+    # from scratch, as a new container would: process_ms from spawning it
+    # to its first response, split into importing final_project and the
+    # first request, then first_chart_ms for the first series request,
+    # which pays for numpy. One run under -X importtime gives the
+    # slowest imports. Bytecode is compiled first, as a deployed image's
+    # would be.
+    package = os.path.dirname(os.path.abspath(__file__))
+    compileall.compile_dir(package, maxlevels=0, quiet=1)
+    env = dict(os.environ, SNAPSHOT='1', PYTHONPATH=package)
+    runs_ms = list()
+    for i in range(runs):
+        command = ([sys.executable, '-c', STARTUP_SCRIPT, repr(time.time())]
+                   + list(paths))
+        output = subprocess.run(command, cwd=directory, env=env, check=True,
+                                capture_output=True, text=True).stdout.split()
+        runs_ms.append([float(x) for x in output[:4]])
+        numpy = output[4] == 'True'
+    process_ms, import_ms, request_ms, chart_ms = [
+        round(statistics.median(x), 1) for x in zip(*runs_ms)]
+
+    report = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import final_project'], cwd=directory, env=env,
+                            check=True, capture_output=True, text=True).stderr
+    imports = dict()
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line.split('|')
+        depth = len(name) - len(name.lstrip())
+        if depth == 1:  # A module's imports are listed before it.
+            if name.strip() == 'final_project':
+                break
+            imports.clear()  # Those of site's .pth files, for one.
+        elif depth == 3:
+            imports[name.strip()] = round(int(cumulative_us) / 1000, 1)
+    slowest = dict(sorted(imports.items(), key=lambda x: -x[1])
+                   [:STARTUP_IMPORTS])
+    print('startup process_ms=%.1f import_ms=%.1f first_request_ms=%.1f '
+          'first_chart_ms=%.1f numpy_at_import=%s'
+          % (process_ms, import_ms, request_ms, chart_ms, numpy))
+    print('startup slowest imports: ' + ', '.join(
+        '%s=%.1f' % x for x in slowest.items()))
+    return {'process_ms': process_ms, 'import_ms': import_ms,
+            'first_request_ms': request_ms, 'first_chart_ms': chart_ms,
+            'numpy_at_import': numpy, 'imports_ms': slowest}
+
+
+def max_rss_mb(who):
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+# Baseline values that should not go up, and those that should not go
+# down, by more than the tolerance between two runs. Timings of a request
+# also have to move by more than MIN_REGRESSION_MS, so that jitter in
+# sub-millisecond routes isn't reported. Tail percentiles are recorded
+# but too noisy over a few dozen requests to fail a run on.
+LOWER_IS_BETTER = ['seconds', 'p50_ms', 'cached_p50_ms', 'max_rss_mb',
+                   'process_ms', 'import_ms', 'first_request_ms']
+HIGHER_IS_BETTER = ['rows_per_sec', 'req_per_sec']
+MIN_REGRESSION_MS = 1.0
+
+
+def is_regression(key, old, new, tolerance):
+    if key.endswith('_ms') and new - old <= MIN_REGRESSION_MS:
+        return False
+    if key == 'req_per_sec' and 1000 / new - 1000 / old <= MIN_REGRESSION_MS:
+        return False
+    if key in LOWER_IS_BETTER:
+        return new > old * (1 + tolerance)
+    if key in HIGHER_IS_BETTER:
+        return new < old / (1 + tolerance)
+    return key == 'status' and new != old
+
+
+def compare_baselines(old, new, tolerance, path=''):
+    # Returns a line for each value in new that is worse than in old.
+    regressions = list()
+    for key, value in new.items():
+        if key not in old:
+            continue
+        if isinstance(value, dict):
+            regressions += compare_baselines(old[key], value, tolerance,
+                                             path + key + '.')
+        elif is_regression(key, old[key], value, tolerance):
+            regressions.append('%s%s %s -> %s' % (path, key, old[key], value))
+    return regressions
+
+
+def bench_suite(days, counties, states, requests_per_route, output,
+                baseline=None, tolerance=0.25):
+    # The whole pipeline on synthetic data: a full main_data_setup from a
+    # local fixture server, then every route through the Flask test
+    # client. Results go to output as JSON; given the JSON of an earlier
+    # run as baseline, values worse by more than tolerance are reported
+    # and the exit status is 1.
+    result = {'scale': {'days': days, 'counties': counties, 'states': states},
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version}
+    with tempfile.TemporaryDirectory() as fixtures:
+        write_fixtures(fixtures, days, counties, states)
+        with serve_fixtures(fixtures) as base_url, \
+                tempfile.TemporaryDirectory() as scratch, \
+                fixture_data_setup(base_url, scratch):
+            # The ingest runs in a child process so that its peak memory,
+            # sqlite's included, can be told apart from the routes'.
+            setup = multiprocessing.get_context('fork').Process(
+                target=data_setup.main_data_setup)
+            start = time.perf_counter()
+            setup.start()
+            setup.join()
+            elapsed = time.perf_counter() - start
+            if setup.exitcode != 0:
+                sys.exit('main_data_setup failed')
+            rows = days * (1 + states + counties)
+            result['ingest'] = {
+                'rows': rows, 'seconds': round(elapsed, 3),
+                'rows_per_sec': round(rows / elapsed),
+                'max_rss_mb': max_rss_mb(resource.RUSAGE_CHILDREN),
+                'database_mb': round(os.path.getsize(
+                    data_setup.PROJECT_DATABASE_NAME) / 2**20, 1)}
+            print('suite ingest rows=%d seconds=%.2f rows/sec=%.0f '
+                  'max_rss_mb=%.1f' % (rows, elapsed, rows / elapsed,
+                                       result['ingest']['max_rss_mb']))
+
+            app = final_project.create_app()
+            requests = suite_requests(days, counties, states)
+            result['routes'] = bench_routes(app, requests, requests_per_route)
+            adapter = app.url_map.bind('localhost')
+            covered = {adapter.match(path.split('?')[0], method)[0]
+                       for method, path, form in requests.values()}
+            result['uncovered'] = sorted(
+                {x.endpoint for x in app.url_map.iter_rules()} - covered)
+            result['max_rss_mb'] = max_rss_mb(resource.RUSAGE_SELF)
+
+            snapshot = os.path.join(scratch, 'snapshot')
+            data_setup.write_snapshot(snapshot)
+            result['startup'] = bench_startup(snapshot, 5)
+
+    with open(output, 'w') as output_file:
+        json.dump(result, output_file, indent=2, sort_keys=True)
+    print('suite wrote ' + output)
+    if result['uncovered']:
+        print('suite routes not exercised: ' + ', '.join(result['uncovered']))
+
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            regressions = compare_baselines(json.load(baseline_file), result,
+                                            tolerance)
+        for line in regressions:
+            print('regression ' + line)
+        if regressions:
+            sys.exit(1)
+        print('suite no regressions against ' + baseline)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Performance benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help='Streaming CSV ingest.')
+    ingest.add_argument('--rows', type=int, nargs='+',
+                        default=[100000, 400000, 1600000])
+    bulk = commands.add_parser('bulk', help='Full county load, bulk mode.')
+    bulk.add_argument('--rows', type=int, nargs='+',
+                      default=[1000000, 4000000])
+    storage = commands.add_parser('storage',
+                                  help='County table size, text vs compact.')
+    storage.add_argument('--rows', type=int, nargs='+',
+                         default=[1000000, 4000000])
+    storage.add_argument('--lookups', type=int, default=500)
+    load = commands.add_parser('load', help='Concurrent HTTP load test.')
+    load.add_argument('--url', default='http://127.0.0.1:5000')
+    load.add_argument('--paths', nargs='+',
+                      default=['/', '/us', '/state', '/county/26'])
+    load.add_argument('--requests', type=int, default=200)
+    load.add_argument('--concurrency', type=int, default=16)
+    workers = commands.add_parser('workers',
+                                  help='Throughput by gunicorn worker count.')
+    workers.add_argument('--workers', type=int, nargs='+',
+                         default=sorted({1, 2, 4, os.cpu_count()}))
+    workers.add_argument('--paths', nargs='+',
+                         default=['/', '/us', '/state', '/county/26',
+                                  '/api/v1/series/county/26161'])
+    workers.add_argument('--requests', type=int, default=200)
+    workers.add_argument('--concurrency', type=int, default=16)
+    wire = commands.add_parser('wire',
+                               help='Response size and time per route.')
+    wire.add_argument('--url', default='http://127.0.0.1:5000')
+    wire.add_argument('--paths', nargs='+',
+                      default=['/us/us_graph_both',
+                               '/api/v1/series/us',
+                               '/state/state_compare/cases_desc/cases',
+                               '/api/v1/compare/state/cases_desc/cases',
+                               '/county/county_details/26/26161/2020-06-01',
+                               '/api/v1/series/county/26161'])
+    wire.add_argument('--requests', type=int, default=20)
+    series = commands.add_parser('series',
+                                 help='Series lookup: sqlite vs store.')
+    series.add_argument('--level', default='county',
+                        choices=series_store.SERIES_LEVELS)
+    series.add_argument('--lookups', type=int, default=1000)
+    search_parser = commands.add_parser('search',
+                                        help='Name index autocomplete.')
+    search_parser.add_argument('--lookups', type=int, default=10000)
+    revisions = commands.add_parser(
+        'revisions', help='Fail on duplicate rows after a county rename.')
+    revisions.add_argument('--rows', type=int, default=300000)
+    commands.add_parser('plans', help='Fail on route queries that scan.')
+    fetch = commands.add_parser('fetch',
+                                help='Sequential vs concurrent downloads.')
+    fetch.add_argument('--latency', type=float, default=0.5)
+    fetch.add_argument('--failures', type=int, default=1)
+    startup = commands.add_parser('startup',
+                                  help='Cold start from a snapshot.')
+    startup.add_argument('--snapshot', metavar='DIRECTORY', required=True)
+    startup.add_argument('--runs', type=int, default=10)
+    suite = commands.add_parser('suite',
+                                help='Ingest and every route on fixtures.')
+    suite.add_argument('--days', type=int, default=120)
+    suite.add_argument('--counties', type=int, default=3000)
+    suite.add_argument('--states', type=int, default=50)
+    suite.add_argument('--requests', type=int, default=30)
+    suite.add_argument('--output', default='benchmark_baseline.json')
+    suite.add_argument('--compare', metavar='BASELINE')
+    suite.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        bench_ingest(args.rows)
+    elif args.command == 'bulk':
+        bench_bulk(args.rows)
+    elif args.command == 'storage':
+        bench_storage(args.rows, args.lookups)
+    elif args.command == 'load':
+        bench_load(args.url, args.paths, args.requests, args.concurrency)
+    elif args.command == 'workers':
+        bench_workers(args.workers, args.paths, args.requests,
+                      args.concurrency)
+    elif args.command == 'wire':
+        bench_wire(args.url, args.paths, args.requests)
+    elif args.command == 'series':
+        bench_series(args.level, args.lookups)
+    elif args.command == 'search':
+        bench_search(args.lookups)
+    elif args.command == 'revisions':
+        bench_revisions(args.rows)
+    elif args.command == 'plans':
+        bench_plans()
+    elif args.command == 'fetch':
+        bench_fetch(args.latency, args.failures)
+    elif args.command == 'startup':
+        bench_startup(args.snapshot, args.runs)
+    elif args.command == 'suite':
+        bench_suite(args.days, args.counties, args.states, args.requests,
+                    args.output, args.compare, args.tolerance)
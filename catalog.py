@@ -0,0 +1,74 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+CATALOG_SNAPSHOT = 'catalog.json'
+
+
+class Catalog:
+    # In-memory copy of the catalog_dates and catalog_places tables built by
+    # data_setup: the dates, places and names the pages list. It is read
+    # once per data version instead of on every request, starting from the
+    # copy data_setup saves in CATALOG_SNAPSHOT, so a new process can serve
+    # its first pages without querying for it.
+
+    def __init__(self, snapshot=CATALOG_SNAPSHOT):
+        # (version, catalog), swapped as one.
+        self.loaded = read_snapshot(snapshot)
+        self.lock = threading.Lock()
+
+    def get(self, cursor, version):
+        loaded_version, catalog = self.loaded
+        if catalog is not None and loaded_version == version:
+            return catalog
+        with self.lock:
+            loaded_version, catalog = self.loaded
+            if catalog is None or loaded_version != version:
+                try:
+                    catalog = load_catalog(cursor)
+                except sqlite3.OperationalError:
+                    return empty_catalog()  # Not built by data_setup yet.
+                self.loaded = (version, catalog)
+            return catalog
+
+
+def empty_catalog():
+    return {'dates': {'us': [], 'state': [], 'county': []},
+            'states': [], 'counties': dict(),
+            'state_names': dict(), 'county_names': dict()}
+
+
+def load_catalog(cursor):
+    catalog = empty_catalog()
+    cmd = 'SELECT level, date FROM catalog_dates ORDER BY level, date;'
+    for level, date in cursor.execute(cmd).fetchall():
+        catalog['dates'][level].append(date)
+
+    cmd = ('SELECT level, fips, state_fips, name FROM catalog_places '
+           'ORDER BY level, fips;')
+    for level, fips, state_fips, name in cursor.execute(cmd).fetchall():
+        if level == 'state':
+            catalog['states'].append(fips)
+            catalog['state_names'][fips] = name
+        else:
+            catalog['counties'].setdefault(state_fips, []).append(fips)
+            catalog['county_names'][fips] = name
+    return catalog
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return (None, None)
+    return (snapshot['version'], snapshot['catalog'])
+
+
+def write_snapshot(cursor, version, path=CATALOG_SNAPSHOT):
+    snapshot = {'version': version, 'catalog': load_catalog(cursor)}
+    with open(path + '.tmp', 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
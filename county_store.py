@@ -0,0 +1,108 @@
+import datetime
+
+
+# The NYT county file is by far the largest source, so it isn't stored as
+# text like the others. county_compact holds (county_id, day, cases,
+# deaths) as integers, clustered on (county_id, day) in a WITHOUT ROWID
+# table, with days counted from 1970-01-01 (numpy's datetime64[D]).
+# county_keys holds each county's fips, county and state names once. A
+# county_id is the fips as an integer, or EXTRA_IDS and up for the places
+# the NYT gives no fips (such as New York City). The county view joins the
+# two back into the original columns for anything that reads them as text.
+COUNTY_TABLES = ['county_keys', 'county_compact']
+COUNTY_COLUMNS = ['date', 'county', 'state', 'fips', 'cases', 'deaths']
+EPOCH = datetime.date(1970, 1, 1)
+EXTRA_IDS = 100000  # Above every 5 digit fips.
+COUNTY_VIEW = ("CREATE VIEW county AS SELECT " +
+               "date(C.day*86400,'unixepoch') AS date, K.county, K.state, " +
+               "K.fips, C.cases, C.deaths, substr(K.fips,1,2) AS state_fips " +
+               "FROM county_compact AS C INNER JOIN county_keys AS K " +
+               "ON K.county_id=C.county_id;")
+SERIES_QUERY = ("SELECT K.fips, C.day, C.cases, C.deaths " +
+                "FROM county_compact AS C INNER JOIN county_keys AS K " +
+                "ON K.county_id=C.county_id WHERE K.fips<>'';")
+# The county_id that stands for each fips in tables kept by fips rather
+# than by name: the fips itself where that is a number.
+FIPS_IDS = ("SELECT fips, min(county_id) AS county_id FROM county_keys " +
+            "WHERE fips<>'' GROUP BY fips;")
+UPSERT = ("INSERT INTO county_compact VALUES (?,?,?,?) " +
+          "ON CONFLICT (county_id, day) DO UPDATE SET " +
+          "cases=excluded.cases, deaths=excluded.deaths " +
+          "WHERE cases<>excluded.cases OR deaths<>excluded.deaths;")
+
+
+def day_number(date):
+    return (datetime.date.fromisoformat(date) - EPOCH).days
+
+
+def day_date(day):
+    return (EPOCH + datetime.timedelta(days=day)).isoformat()
+
+
+def create_tables(cursor, suffix=''):
+    cursor.execute("CREATE TABLE county_keys" + suffix +
+                   " (county_id INTEGER PRIMARY KEY, fips TEXT NOT NULL, " +
+                   "county TEXT NOT NULL, state TEXT NOT NULL);")
+    cursor.execute("CREATE TABLE county_compact" + suffix +
+                   " (county_id INTEGER NOT NULL, day INTEGER NOT NULL, " +
+                   "cases INTEGER NOT NULL, deaths INTEGER NOT NULL, " +
+                   "PRIMARY KEY (county_id, day)) WITHOUT ROWID;")
+
+
+class CountyKeys:
+    # The county_id of each fips, or of each (county, state) for the places
+    # the NYT gives no fips, adding the ones not seen before to the keys
+    # table as they come up. A county the NYT renames keeps its county_id
+    # and takes the new name, so its revisions replace the rows stored
+    # under the old one.
+
+    def __init__(self, cursor, table='county_keys'):
+        self.cursor = cursor
+        self.table = table
+        cmd = ("SELECT county_id, county, state, fips FROM " + table +
+               " ORDER BY county_id DESC;")
+        rows = cursor.execute(cmd).fetchall()
+        self.ids = {x[3] or (x[1], x[2]): x[0] for x in rows}
+        self.names = {x[0]: (x[1], x[2]) for x in rows}
+        self.next_extra = max([x[0] + 1 for x in rows if x[0] >= EXTRA_IDS],
+                              default=EXTRA_IDS)
+
+    def get(self, county, state, fips):
+        county_id = self.ids.get(fips or (county, state))
+        if county_id is not None:
+            if self.names[county_id] != (county, state):
+                self.names[county_id] = (county, state)
+                cmd = ("UPDATE " + self.table + " SET county=?, state=? " +
+                       "WHERE county_id=?;")
+                self.cursor.execute(cmd, (county, state, county_id))
+            return county_id
+        if fips.isdigit() and int(fips) < EXTRA_IDS \
+                and int(fips) not in self.names:
+            county_id = int(fips)
+        else:
+            county_id = self.next_extra
+            self.next_extra += 1
+        self.names[county_id] = (county, state)
+        self.ids[fips or (county, state)] = county_id
+        cmd = "INSERT INTO " + self.table + " VALUES (?,?,?,?);"
+        self.cursor.execute(cmd, (county_id, fips, county, state))
+        return county_id
+
+
+def compact_rows(rows, data_header, keys):
+    # Converted NYT rows (see data_setup.iter_covid_rows) as county_compact
+    # rows.
+    date, county, state, fips, cases, deaths = [data_header.index(x)
+                                                for x in COUNTY_COLUMNS]
+    days = dict()
+    for row in rows:
+        day = days.get(row[date])
+        if day is None:
+            day = days[row[date]] = day_number(row[date])
+        yield (keys.get(row[county], row[state], row[fips]), day, row[cases],
+               row[deaths])
+
+
+def newest_date(cursor):
+    day = cursor.execute("SELECT max(day) FROM county_compact;").fetchone()[0]
+    return None if day is None else day_date(day)
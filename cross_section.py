@@ -0,0 +1,113 @@
+import sqlite3
+
+import county_store
+import lazy
+import series_store
+
+np = lazy.LazyModule('numpy')
+
+
+# Every place's indicators on a single date, for the maps. The store keeps
+# each level's rows of the <level>_indicators table sorted by (date, fips)
+# under the name <level>_by_date in the series cache, so that a date is
+# one contiguous slice of each memory-mapped column.
+CROSS_SECTION_LEVELS = ['state', 'county']
+CROSS_SECTION_COLUMNS = ['cases', 'deaths', 'new_cases', 'new_deaths',
+                         'avg_cases', 'avg_deaths', 'cases_per_100k',
+                         'deaths_per_100k', 'avg_cases_per_100k',
+                         'doubling_days', 'cfr']
+INTEGER_COLUMNS = {'cases', 'deaths', 'new_cases', 'new_deaths'}
+
+
+def store_name(level):
+    return level + '_by_date'
+
+
+def to_columns(rows):
+    # Rows of (date, fips, CROSS_SECTION_COLUMNS...) as a dict of arrays,
+    # with NULLs as NaN.
+    columns = {'date': np.array([x[0] for x in rows], dtype='datetime64[D]'),
+               'fips': np.array([x[1] for x in rows], dtype=str)}
+    for i, column in enumerate(CROSS_SECTION_COLUMNS, 2):
+        kind = np.int64 if column in INTEGER_COLUMNS else float
+        columns[column] = np.array([x[i] for x in rows], dtype=kind)
+    return columns
+
+
+def level_query(level):
+    return ("SELECT date, fips, " + ','.join(CROSS_SECTION_COLUMNS) +
+            " FROM " + level + "_indicators")
+
+
+def read_columns(cursor, query):
+    # to_columns of every row of query, converted series_store.FETCH_ROWS
+    # at a time so that a whole level is never held as Python rows. None
+    # when there are no rows.
+    cursor.execute(query)
+    chunks = list()
+    while True:
+        rows = cursor.fetchmany(series_store.FETCH_ROWS)
+        if not rows:
+            break
+        chunks.append(to_columns(rows))
+    if not chunks:
+        return None
+    return {x: np.concatenate([y[x] for y in chunks]) for x in chunks[0]}
+
+
+def build_cross_sections(cursor, version,
+                         directory=series_store.SERIES_CACHE_DIR):
+    for level in CROSS_SECTION_LEVELS:
+        name = store_name(level)
+        if series_store.stored_version(name, directory) == version:
+            continue
+        try:
+            columns = read_columns(cursor, level_query(level) + ";")
+        except sqlite3.OperationalError:
+            continue  # No indicators for this level yet.
+
+        offsets = dict()
+        if columns is None:
+            columns = dict()
+        else:
+            order = np.lexsort((columns['fips'], columns['date']))
+            columns = {x: y[order] for x, y in columns.items()}
+            dates = np.datetime_as_string(columns.pop('date'), unit='D')
+            starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+            offsets = series_store.group_offsets(dates, starts)
+        series_store.write_build(name, version, columns, offsets, directory)
+
+
+def get_cross_section(store, cursor, level, date, version):
+    # {'fips': ..., CROSS_SECTION_COLUMNS...} arrays for every place on
+    # date, from the store or, until it has been rebuilt, from sqlite.
+    # None when there is no data for that date.
+    loaded = store.load_level(store_name(level), version)
+    if loaded is None:
+        return query_cross_section(cursor, level, date)
+    if date not in loaded['offsets']:
+        return None
+    start, stop = loaded['offsets'][date]
+    return {x: loaded[x][start:stop] for x in ['fips'] + CROSS_SECTION_COLUMNS}
+
+
+def date_query(level, date):
+    # (sql, parameters) for one date, through the level's date index, which
+    # for counties is on day numbers. ValueError for a malformed county
+    # date.
+    if level == 'county':
+        return (level_query(level) + " WHERE day=? ORDER BY fips;",
+                (county_store.day_number(date),))
+    return level_query(level) + " WHERE date=? ORDER BY fips;", (date,)
+
+
+def query_cross_section(cursor, level, date):
+    try:
+        rows = cursor.execute(*date_query(level, date)).fetchall()
+    except ValueError:
+        return None
+    if not rows:
+        return None
+    columns = to_columns(rows)
+    del columns['date']
+    return columns
@@ -3,24 +3,108 @@
 ##### Uniqname: cplotts
 #################################
 
-import requests
+import argparse
 import secrets
 import sqlite3
 import datetime
 import json
+import csv
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import concurrent.futures
+import contextlib
+import catalog
+import county_store
+import cross_section
+import geo
+import http_cache
+import indicators
+import lazy
+import metrics
+import series_store
 # import sys
 
+requests = lazy.LazyModule('requests')  # Only needed to download.
+
 NYT_COVID19_BASE = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/'
 NYT_INT_LIST = ['cases', 'deaths']
 CENSUS_POP_BASE = 'https://api.census.gov/data/2019/pep/population'
+COUNTY_GEOJSON_URL = ('https://raw.githubusercontent.com/plotly/datasets/'
+                      'master/geojson-counties-fips.json')
 CENSUS_INT_LIST = 'pop'
 CENSUS_FLOAT_LIST = 'density'
 PROJECT_DATABASE_NAME = 'project_data.sqlite'
+INGEST_BATCH_SIZE = 10000  # Rows per executemany call while streaming.
+REVISION_WINDOW_DAYS = 14  # How far back an incremental refresh looks for revisions.
+SYSTEM_TABLES = {'timings', 'sqlite_sequence', 'sqlite_stat1',
+                 'sqlite_stat4', 'http_validators', 'data_version'}
+COVID_REFRESH_HOURS = 3
+CENSUS_REFRESH_DAYS = 30
+# Set HTTP_CACHE_OFFLINE=1 to build from previously cached responses only.
+HTTP_CACHE_OFFLINE = os.environ.get('HTTP_CACHE_OFFLINE') == '1'
+COVID_SOURCES = [('us', 'us.csv'), ('state', 'us-states.csv'),
+                 ('county', 'us-counties.csv')]
+CENSUS_SOURCES = [('us_census', 'POP,DENSITY', 'us:*'),
+                  ('state_census', 'POP,DENSITY,NAME', 'state:*'),
+                  ('county_census', 'POP,DENSITY,NAME', 'county:*')]
+FETCH_TIMEOUT = (10, 120)  # Seconds to connect, and between bytes received.
+FETCH_WORKERS = 6  # Sources downloaded at once.
+FETCH_RETRIES = 4
+FETCH_BACKOFF = 1.0  # Seconds before the first retry, doubling after that.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+BULK_CACHE_KIB = 512 * 1024  # Page cache while loading, so index sorts fit.
+
+# Derived lookup columns, kept by SQLite itself and indexed below so routes
+# can filter on them instead of on substr()/|| expressions.
+GENERATED_COLUMNS = {
+    'county_census': [('county_fips', 'state||county')],
+}
+# The columns the comparison pages rank places on, each indexed in the
+# latest rollups so that a ranking reads only the rows it returns.
+RANK_COLUMNS = ['cases', 'deaths', 'pop', 'density', 'cases_per_100k',
+                'deaths_per_100k', 'avg_cases_per_100k', 'doubling_days',
+                'cfr']
+TABLE_INDEXES = {
+    'state': [('state_fips_date', 'fips,date'), ('state_date', 'date')],
+    'county_keys': [('county_keys_fips', 'fips')],
+    'state_census': [('state_census_state', 'state')],
+    'county_census': [('county_census_fips', 'county_fips'),
+                      ('county_census_state', 'state')],
+    # For the maps' cross sections until the series cache has them.
+    'state_indicators': [('state_indicators_date', 'date')],
+    'county_indicators_compact': [('county_indicators_day', 'day')],
+    'state_latest': [('state_latest_' + x, x) for x in RANK_COLUMNS],
+    'county_latest': [('county_latest_' + x, 'state_fips,' + x)
+                      for x in RANK_COLUMNS],
+}
+# Views over the compact tables, for anything that reads them like the
+# tables of text they replaced, with the tables each one reads. SQLite
+# won't rename a table while a view reads one that is missing, so swapping
+# in any of those tables drops the view and creates it again after.
+TABLE_VIEWS = {
+    'county': (county_store.COUNTY_VIEW, county_store.COUNTY_TABLES),
+    'county_indicators': (indicators.COUNTY_VIEW, indicators.VIEW_SOURCES),
+}
+# Census population and density of each place, by level, for indicators.
+INDICATOR_SOURCES = {
+    'us': ('us_census', "SELECT '', pop, density FROM us_census;"),
+    'state': ('state_census', "SELECT state, pop, density FROM state_census;"),
+    'county': ('county_census',
+               "SELECT county_fips, pop, density FROM county_census;"),
+}
 
 
 def get_table_timings(connection, cursor):
     timings_dict = dict()
     final_timings_dict = dict()
+    # Everything below is one transaction, committed at the end.
+    connection.commit()
+    cursor.execute("BEGIN;")
     cmd = "SELECT name FROM sqlite_master WHERE [Type]='table';"
     tables = [x[0] for x in cursor.execute(cmd).fetchall()]
 
@@ -28,7 +112,6 @@ def get_table_timings(connection, cursor):
         cmd = ("CREATE TABLE timings" +
                "(tablename TEXT PRIMARY KEY, timestamp TEXT NOT NULL);")
         cursor.execute(cmd)
-        connection.commit()
         tables.append('timings')
         # We're appending an empty timings at the end of this block.
         # This will have the effect of clearing out all other tables
@@ -36,6 +119,28 @@ def get_table_timings(connection, cursor):
         # here unless someone manually goes and deletes it between
         # runs of the program.
 
+    if 'http_validators' not in tables:
+        # digest is the sha256 of the response body the table was built
+        # from. The ETag and Last-Modified used to revalidate it are kept
+        # by http_cache alone.
+        cmd = ("CREATE TABLE http_validators" +
+               "(url TEXT PRIMARY KEY, digest TEXT);")
+        cursor.execute(cmd)
+        tables.append('http_validators')
+
+    if 'data_version' not in tables:
+        # version counts published refreshes and token is new with each,
+        # so that together they are what readers key caches on; pending
+        # marks changes that publish_data_version hasn't announced yet, and
+        # since the first date they changed, '' for all of them.
+        cmd = ("CREATE TABLE data_version" +
+               "(version INTEGER NOT NULL, pending INTEGER NOT NULL, " +
+               "token TEXT NOT NULL, since TEXT NOT NULL DEFAULT '');")
+        cursor.execute(cmd)
+        cmd = "INSERT INTO data_version VALUES (0, 1, ?, '');"
+        cursor.execute(cmd, (uuid.uuid4().hex,))
+        tables.append('data_version')
+
     cmd = "SELECT * FROM timings;"
     timings = cursor.execute(cmd).fetchall()
     for row in timings:
@@ -43,13 +148,12 @@ def get_table_timings(connection, cursor):
 
     for table in tables:  # Clean out tables that aren't in timings.
         if (table not in timings_dict.keys()
-                and table not in {'timings', 'sqlite_sequence'}):
+                and table not in SYSTEM_TABLES):
             cmd = "DROP TABLE " + table + ";"
             cursor.execute(cmd)
-            connection.commit()
 
-    # Fetch updated tables list.
-    cmd = "SELECT name FROM sqlite_master WHERE [Type]='table';"
+    # Fetch updated tables list, with the county view, which has timings.
+    cmd = "SELECT name FROM sqlite_master WHERE [Type] IN ('table','view');"
     tables = [x[0] for x in cursor.execute(cmd).fetchall()]
 
     for row in timings:  # Clean out timings that don't have tables.
@@ -57,157 +161,1126 @@ def get_table_timings(connection, cursor):
             cmd = ("DELETE FROM timings WHERE " +
                    "tablename=? and timestamp=?;")
             cursor.execute(cmd, tuple(row))
-            connection.commit()
         else:
             final_timings_dict[row[0]
                                ] = datetime.datetime.fromisoformat(row[1])
+    connection.commit()
 
     return final_timings_dict
 
 
-def get_covid_data(connection, cursor, timings, table, covid_url, parameters=None):
-    refresh_time = datetime.datetime.now() - datetime.timedelta(hours=3)
+def get_data_version(cursor):
+    # Changed once per refresh that changed any data; see
+    # publish_data_version. The counter alone would start over in a
+    # rebuilt database and match caches built from the old one, so the
+    # version also carries the token, which is unique to each refresh.
+    cmd = "SELECT version, token FROM data_version;"
+    try:
+        version, token = cursor.execute(cmd).fetchone()
+    except sqlite3.OperationalError:  # Not set up by data_setup yet.
+        return 0
+    return str(version) + '-' + token
 
-    if table not in timings.keys():
-        load_covid_data(connection, cursor, table, covid_url)
-        timings = get_table_timings(connection, cursor)
 
-    elif timings[table] < refresh_time:  # Clear out table if 3+ hours old.
-        cmd = "DROP TABLE " + table + ";"
+def mark_data_changed(cursor, since=''):
+    # Called inside the transaction that changes the data, with the first
+    # date it changed, or '' when that could be any of them. build_rollups
+    # rebuilds the rollups it can from since on, rather than in full.
+    cmd = ("UPDATE data_version SET since=CASE WHEN pending=0 THEN ? " +
+           "ELSE min(since, ?) END, pending=1;")
+    cursor.execute(cmd, (since, since))
+
+
+def publish_data_version(connection, cursor):
+    cmd = ("UPDATE data_version SET version=version+1, pending=0, token=? " +
+           "WHERE pending=1;")
+    cursor.execute(cmd, (uuid.uuid4().hex,))
+    connection.commit()
+    return get_data_version(cursor)
+
+
+@contextlib.contextmanager
+def bulk_load(cursor):
+    # Settings for the big writes of an ingest: no fsync on commit and a
+    # large page cache, restored afterwards. A crash can lose the last
+    # load, but it is redone from the source on the next run.
+    synchronous = cursor.execute("PRAGMA synchronous;").fetchone()[0]
+    cache_size = cursor.execute("PRAGMA cache_size;").fetchone()[0]
+    temp_store = cursor.execute("PRAGMA temp_store;").fetchone()[0]
+    cursor.execute("PRAGMA synchronous=OFF;")
+    cursor.execute("PRAGMA cache_size=-" + str(BULK_CACHE_KIB) + ";")
+    cursor.execute("PRAGMA temp_store=MEMORY;")
+    try:
+        yield
+    except BaseException:
+        # synchronous can't be changed inside a transaction, so one a
+        # failed load left open is rolled back before it is restored.
+        cursor.connection.rollback()
+        raise
+    finally:
+        cursor.execute("PRAGMA synchronous=" + str(synchronous) + ";")
+        cursor.execute("PRAGMA cache_size=" + str(cache_size) + ";")
+        cursor.execute("PRAGMA temp_store=" + str(temp_store) + ";")
+
+
+def begin_load(connection, cursor, *tables):
+    # Starts the transaction a full load runs in, with an empty staging
+    # table (table_shadow) for each table for it to fill.
+    connection.commit()
+    cursor.execute("BEGIN;")
+    for table in tables:
+        cursor.execute("DROP TABLE IF EXISTS " + table + "_shadow;")
+
+
+def swap_in_shadow(cursor, table):
+    # Replaces table with the filled table_shadow, then indexes and
+    # analyzes it, inside the load's transaction. Under WAL, readers keep
+    # seeing the old table until the commit, so they never find it empty
+    # or missing.
+    swap_tables(cursor, [table])
+
+
+def swap_in_county(cursor):
+    # swap_in_shadow for county_store's tables, and the view over them.
+    swap_tables(cursor, county_store.COUNTY_TABLES)
+
+
+def swap_tables(cursor, tables):
+    # Every view of TABLE_VIEWS that reads one of tables is dropped for the
+    # swap, and created again once all the tables it reads exist.
+    views = [x for x, y in TABLE_VIEWS.items() if set(tables) & set(y[1])]
+    cmd = "SELECT name, type FROM sqlite_master;"
+    kinds = dict(cursor.execute(cmd).fetchall())
+    for view in views:
+        if kinds.get(view) == 'view':
+            cursor.execute("DROP VIEW " + view + ";")
+    for table in tables:
+        cursor.execute("DROP TABLE IF EXISTS " + table + ";")
+        cursor.execute("ALTER TABLE " + table + "_shadow RENAME TO " +
+                       table + ";")
+        create_table_indexes(cursor, table)
+        kinds[table] = 'table'
+    now = datetime.datetime.now().isoformat()
+    cmd = "INSERT OR REPLACE INTO timings VALUES (?,?);"
+    cursor.executemany(cmd, [(x, now) for x in tables])
+    for view in views:
+        create, sources = TABLE_VIEWS[view]
+        # Not over a table the view is still to replace; see
+        # compact_county_indicators.
+        if kinds.get(view) != 'table' and \
+                all(kinds.get(x) == 'table' for x in sources):
+            cursor.execute(create)
+            cursor.execute(cmd, (view, now))
+    # The indicators and rollups are rebuilt from data already marked
+    # changed, whose since they leave as it is.
+    derived = ROLLUP_TABLES.keys() | {indicators.stored_table(x)[0]
+                                      for x in INDICATOR_SOURCES}
+    pending = cursor.execute("SELECT pending FROM data_version;").fetchone()
+    if not (set(tables) <= derived and pending[0]):
+        mark_data_changed(cursor)
+
+
+def add_lookup_columns_and_indexes(connection, cursor):
+    cmd = "SELECT name FROM sqlite_master WHERE [Type]='table';"
+    tables = [x[0] for x in cursor.execute(cmd).fetchall()]
+    for table, columns in GENERATED_COLUMNS.items():
+        if table not in tables:
+            continue  # Will be created with the columns on first load.
+        cmd = "SELECT name FROM pragma_table_info(?);"
+        existing = [x[0] for x in cursor.execute(cmd, (table,)).fetchall()]
+        for column, expression in columns:
+            if column not in existing:
+                cmd = ("ALTER TABLE " + table + " ADD COLUMN " + column +
+                       " TEXT GENERATED ALWAYS AS (" + expression + ");")
+                cursor.execute(cmd)
+    rebuilt = ROLLUP_TABLES.keys() | {indicators.stored_table(x)[0]
+                                      for x in INDICATOR_SOURCES}
+    for table in TABLE_INDEXES:
+        # The rollups and indicators get theirs when they are rebuilt.
+        if table in tables and table not in rebuilt:
+            create_table_indexes(cursor, table)
+
+
+def add_source_digest_column(connection, cursor):
+    cmd = "SELECT name FROM pragma_table_info('http_validators');"
+    if 'digest' not in [x[0] for x in cursor.execute(cmd).fetchall()]:
+        cmd = "ALTER TABLE http_validators ADD COLUMN digest TEXT;"
+        cursor.execute(cmd)
+
+
+def rebuild_latest_rollups(connection, cursor):
+    # state_latest and county_latest gained the indicator columns. Marking
+    # the data changed has build_indicators and build_rollups rebuild them
+    # in shadows, which they swap in for the old ones.
+    mark_data_changed(cursor)
+
+
+def compact_county_table(connection, cursor):
+    # County rows moved from a table of text into county_store's compact
+    # tables. They are copied over into shadows, and the old table is
+    # dropped in the transaction that swaps them in, so readers go
+    # straight from the old table to the county view.
+    cmd = "SELECT type FROM sqlite_master WHERE name='county';"
+    row = cursor.execute(cmd).fetchone()
+    if row is None or row[0] != 'table':
+        return
+    cmd = "SELECT timestamp FROM timings WHERE tablename='county';"
+    loaded = cursor.execute(cmd).fetchone()[0]
+    begin_load(connection, cursor, *county_store.COUNTY_TABLES)
+    try:
+        county_store.create_tables(cursor, '_shadow')
+        keys = county_store.CountyKeys(cursor, 'county_keys_shadow')
+        cmd = ("SELECT " + ','.join(county_store.COUNTY_COLUMNS) +
+               " FROM county;")
+        rows = county_store.compact_rows(
+            connection.execute(cmd), county_store.COUNTY_COLUMNS, keys)
+        cmd = ("INSERT OR REPLACE INTO county_compact_shadow " +
+               "VALUES (?,?,?,?);")
+        for batch in iter_batches(rows):
+            cursor.executemany(cmd, batch)
+        cursor.execute("DROP TABLE county;")
+        swap_in_county(cursor)
+        # The rows are as old as the table they came from.
+        cmd = "UPDATE timings SET timestamp=? WHERE tablename IN (?,?,?);"
+        cursor.execute(cmd, tuple([loaded, 'county'] +
+                                  county_store.COUNTY_TABLES))
+        for table in county_store.COUNTY_TABLES:
+            cursor.execute("ANALYZE " + table + ";")
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+def add_data_version_token(connection, cursor):
+    cmd = "SELECT name FROM pragma_table_info('data_version');"
+    if 'token' not in [x[0] for x in cursor.execute(cmd).fetchall()]:
+        cmd = ("ALTER TABLE data_version ADD COLUMN token TEXT NOT NULL " +
+               "DEFAULT '';")
+        cursor.execute(cmd)
+        cursor.execute("UPDATE data_version SET token=?;",
+                       (uuid.uuid4().hex,))
+
+
+def compact_county_indicators(connection, cursor):
+    # The county_indicators table became indicators.COUNTY_VIEW over
+    # county_indicators_compact. Its rows are copied over into a shadow,
+    # and the table is dropped in the transaction that swaps the shadow in
+    # and creates the view in its place.
+    cmd = "SELECT type FROM sqlite_master WHERE name='county_indicators';"
+    row = cursor.execute(cmd).fetchone()
+    if row is None or row[0] != 'table':
+        return
+    cmd = "SELECT timestamp FROM timings WHERE tablename='county_indicators';"
+    loaded = cursor.execute(cmd).fetchone()[0]
+    table = indicators.stored_table('county')[0]
+    begin_load(connection, cursor, table)
+    try:
+        create_indicator_shadow(cursor, 'county')
+        cmd = ("INSERT INTO " + table + "_shadow SELECT K.county_id, " +
+               "CAST(julianday(I.date)-julianday('1970-01-01') AS INTEGER), " +
+               ','.join('I.' + x for x, y in indicators.VALUE_COLUMNS) +
+               " FROM county_indicators AS I INNER JOIN (" +
+               county_store.FIPS_IDS.rstrip(';') + ") AS K " +
+               "ON K.fips=I.fips;")
         cursor.execute(cmd)
+        cursor.execute("DROP TABLE county_indicators;")
+        swap_in_shadow(cursor, table)
+        # The rows are as old as the table they came from.
+        cmd = "UPDATE timings SET timestamp=? WHERE tablename IN (?,?);"
+        cursor.execute(cmd, (loaded, table, 'county_indicators'))
+        cursor.execute("ANALYZE " + table + ";")
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+def add_date_and_rank_indexes(connection, cursor):
+    # The indicator and rollup tables gained indexes, which they get as
+    # build_indicators and build_rollups swap them in again. Marking the
+    # data changed has that happen on this run.
+    mark_data_changed(cursor)
+
+
+def drop_county_totals(connection, cursor):
+    # county_totals_by_state had a row per state for the latest date only.
+    # It is built again when missing, with a row per state and date.
+    cursor.execute("DROP TABLE IF EXISTS county_totals_by_state;")
+    cmd = "DELETE FROM timings WHERE tablename='county_totals_by_state';"
+    cursor.execute(cmd)
+
+
+def drop_http_validator_columns(connection, cursor):
+    # etag and last_modified were written but never read; http_cache keeps
+    # the validators it revalidates with. The table is copied without them
+    # rather than with ALTER TABLE DROP COLUMN, which needs SQLite 3.35.
+    cmd = "SELECT name FROM pragma_table_info('http_validators');"
+    if 'etag' not in [x[0] for x in cursor.execute(cmd).fetchall()]:
+        return
+    cmd = ("CREATE TABLE http_validators_shadow" +
+           "(url TEXT PRIMARY KEY, digest TEXT);")
+    cursor.execute(cmd)
+    cmd = ("INSERT INTO http_validators_shadow " +
+           "SELECT url, digest FROM http_validators;")
+    cursor.execute(cmd)
+    cursor.execute("DROP TABLE http_validators;")
+    cmd = "ALTER TABLE http_validators_shadow RENAME TO http_validators;"
+    cursor.execute(cmd)
+
+
+def merge_renamed_counties(connection, cursor):
+    # county_store gave a county the NYT renamed a second county_id, so a
+    # revision added rows for dates its old id already had. Each one's rows
+    # move to the fips's first county_id, which takes the newest name;
+    # later ids were added later, so their rows replace the older ones.
+    cmd = "SELECT type FROM sqlite_master WHERE name='county_keys';"
+    if cursor.execute(cmd).fetchone() is None:
+        return
+    cmd = ("SELECT K.county_id, F.county_id FROM county_keys AS K " +
+           "INNER JOIN (" + county_store.FIPS_IDS.rstrip(';') + ") AS F " +
+           "ON F.fips=K.fips WHERE K.county_id<>F.county_id " +
+           "ORDER BY K.county_id;")
+    renamed = cursor.execute(cmd).fetchall()
+    for old_id, county_id in renamed:
+        cmd = ("INSERT OR REPLACE INTO county_compact " +
+               "SELECT ?, day, cases, deaths FROM county_compact " +
+               "WHERE county_id=?;")
+        cursor.execute(cmd, (county_id, old_id))
+        cursor.execute("DELETE FROM county_compact WHERE county_id=?;",
+                       (old_id,))
+        cmd = ("UPDATE county_keys SET (county, state)=" +
+               "(SELECT county, state FROM county_keys WHERE county_id=?) " +
+               "WHERE county_id=?;")
+        cursor.execute(cmd, (old_id, county_id))
+        cursor.execute("DELETE FROM county_keys WHERE county_id=?;",
+                       (old_id,))
+    if renamed:
+        mark_data_changed(cursor)
+
+
+def add_data_version_since(connection, cursor):
+    cmd = "SELECT name FROM pragma_table_info('data_version');"
+    if 'since' not in [x[0] for x in cursor.execute(cmd).fetchall()]:
+        cmd = ("ALTER TABLE data_version ADD COLUMN since TEXT NOT NULL " +
+               "DEFAULT '';")
+        cursor.execute(cmd)
+
+
+def drop_state_fips_column(connection, cursor):
+    # state had a generated state_fips, substr(fips,1,2), which is its fips
+    # and was never read. The table is copied without it into a shadow
+    # swapped in for it, rather than with ALTER TABLE DROP COLUMN, which
+    # needs SQLite 3.35. pragma_table_info leaves out generated columns.
+    cmd = "SELECT name FROM pragma_table_xinfo('state');"
+    if 'state_fips' not in [x[0] for x in cursor.execute(cmd).fetchall()]:
+        return
+    cmd = "SELECT name, type, [notnull] FROM pragma_table_info('state');"
+    columns = [x for x in cursor.execute(cmd).fetchall() if x[0] != 'ID']
+    data_header = [x[0] for x in columns]
+    cmd = "SELECT timestamp FROM timings WHERE tablename='state';"
+    loaded = cursor.execute(cmd).fetchone()[0]
+    begin_load(connection, cursor, 'state')
+    try:
+        cmd = ("CREATE TABLE state_shadow ('ID' INTEGER PRIMARY KEY, " +
+               ','.join(x + ' ' + y + (' NOT NULL' if z else '')
+                        for x, y, z in columns) + ");")
+        cursor.execute(cmd)
+        cmd = ("INSERT INTO state_shadow SELECT ID, " +
+               ','.join(data_header) + " FROM state;")
+        cursor.execute(cmd)
+        swap_in_shadow(cursor, 'state')
+        create_covid_key_index(cursor, 'state', data_header)
+        # The rows are as old as the table they came from.
+        cmd = "UPDATE timings SET timestamp=? WHERE tablename='state';"
+        cursor.execute(cmd, (loaded,))
+        cursor.execute("ANALYZE state;")
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+# Each migration upgrades an existing database by one step; PRAGMA
+# user_version records how many have been applied. Only ever append here.
+SCHEMA_MIGRATIONS = [add_lookup_columns_and_indexes, add_source_digest_column,
+                     rebuild_latest_rollups, compact_county_table,
+                     add_data_version_token, compact_county_indicators,
+                     add_date_and_rank_indexes, drop_county_totals,
+                     drop_http_validator_columns, merge_renamed_counties,
+                     add_data_version_since, drop_state_fips_column]
+
+
+def migrate_schema(connection, cursor):
+    version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+    for number, migration in enumerate(SCHEMA_MIGRATIONS[version:],
+                                       version + 1):
+        migration(connection, cursor)
+        cursor.execute("PRAGMA user_version=" + str(number) + ";")
         connection.commit()
+
+
+def generated_column_sql(table):
+    cmd_list = list()
+    for column, expression in GENERATED_COLUMNS.get(table, []):
+        cmd_list.append(column + ' TEXT GENERATED ALWAYS AS (' +
+                        expression + ')')
+    return cmd_list
+
+
+def create_table_indexes(cursor, table):
+    for name, columns in TABLE_INDEXES.get(table, []):
+        cmd = ("CREATE INDEX IF NOT EXISTS " + name + " ON " + table +
+               " (" + columns + ");")
+        cursor.execute(cmd)
+
+
+def get_covid_data(connection, cursor, timings, table, covid_url, parameters=None,
+                   incremental=True, fetched=None):
+    refresh_time = (datetime.datetime.now() -
+                    datetime.timedelta(hours=COVID_REFRESH_HOURS))
+
+    if table not in timings.keys():
+        load_covid_data(connection, cursor, table, covid_url, fetched)
         timings = get_table_timings(connection, cursor)
-        load_covid_data(connection, cursor, table, covid_url)
+
+    elif timings[table] < refresh_time and incremental:
+        # Upsert new/revised rows in place so readers never see a gap.
+        refresh_covid_data(connection, cursor, table, covid_url, fetched)
+        timings = get_table_timings(connection, cursor)
+
+    elif timings[table] < refresh_time:  # Reload fully if 3+ hours old.
+        load_covid_data(connection, cursor, table, covid_url, fetched)
         timings = get_table_timings(connection, cursor)
-        
 
-    cmd = "SELECT * FROM " + table + ";"
-    data = cursor.execute(cmd).fetchall()
+    return timings
 
-    return timings, data
 
+def load_covid_data(connection, cursor, table, covid_url, fetched=None):
+    source = fetched or fetch_covid_csv(covid_url)
+    load_covid_file(connection, cursor, table, source['path'])
+    save_loaded_digest(cursor, covid_url, source)
+    connection.commit()
+
+    return
+
+
+def load_covid_file(connection, cursor, table, path):
+    # The whole load is one transaction, left open for the caller to
+    # commit: rows go into the staging table with no indexes to maintain,
+    # which are then built once, after the swap.
+    if table == 'county':
+        return load_county_file(connection, cursor, path)
+    begin_load(connection, cursor, table)
+    try:
+        with open_csv_stream(path) as csv_stream:
+            data_header = store_covid_csv(connection, cursor,
+                                          table + '_shadow', csv_stream,
+                                          schema=table)
+        with metrics.stage('index', table):
+            swap_in_shadow(cursor, table)
+            create_covid_key_index(cursor, table, data_header)
+            cursor.execute("ANALYZE " + table + ";")
+    except BaseException:
+        connection.rollback()
+        raise
+    return data_header
 
-def load_covid_data(connection, cursor, table, covid_url):
+
+def load_county_file(connection, cursor, path):
+    # load_covid_file for the county file, into county_store's tables.
+    begin_load(connection, cursor, *county_store.COUNTY_TABLES)
     try:
-        returned_request = requests.get(covid_url)
-    except:
-        print('Exception in load_csv_data, trying again...')
-        returned_request = requests.get(covid_url)
+        county_store.create_tables(cursor, '_shadow')
+        keys = county_store.CountyKeys(cursor, 'county_keys_shadow')
+        with open_csv_stream(path) as csv_stream:
+            reader = csv.reader(csv_stream)
+            data_header = next(reader)
+            rows = county_store.compact_rows(
+                iter_covid_rows(reader, data_header), data_header, keys)
+            # A fips given twice for a date, under an old and a new name,
+            # keeps the row that comes last.
+            cmd = ("INSERT OR REPLACE INTO county_compact_shadow " +
+                   "VALUES (?,?,?,?);")
+            for batch in metrics.timed_batches(iter_batches(rows), 'county'):
+                with metrics.stage('insert', 'county'):
+                    cursor.executemany(cmd, batch)
+        with metrics.stage('index', 'county'):
+            swap_in_county(cursor)
+            for table in county_store.COUNTY_TABLES:
+                cursor.execute("ANALYZE " + table + ";")
+    except BaseException:
+        connection.rollback()
+        raise
+    return data_header
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive session shared by every download thread. requests
+    # already asks for gzip and transparently decodes it.
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=8)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
 
-    data_lines = returned_request.text.splitlines()
-    data_header = data_lines.pop(0).split(',')
+def download(url, params=None, headers=None, directory=None):
+    # Spools the body to a temp file so downloads can run in parallel
+    # while the DB writes that read them stay serialized. Returns the
+    # response and the file path (None when the server answered 304).
+    # Failed connections, timeouts, 5xx and 429 answers and bodies cut off
+    # midway all draw on the same FETCH_RETRIES retries.
+    for attempt in range(FETCH_RETRIES + 1):
+        spool = None
+        try:
+            returned_request = get_session().get(
+                url, params=params, headers=headers, stream=True,
+                timeout=FETCH_TIMEOUT)
+            if returned_request.status_code == 304:
+                returned_request.close()
+                return returned_request, None
+            if (returned_request.status_code < 500
+                    and returned_request.status_code != 429):
+                returned_request.raise_for_status()
+                spool = tempfile.NamedTemporaryFile(suffix='.download',
+                                                    delete=False,
+                                                    dir=directory)
+                with spool, returned_request:
+                    for chunk in returned_request.iter_content(
+                            DOWNLOAD_CHUNK_SIZE):
+                        spool.write(chunk)
+                return returned_request, spool.name
+            returned_request.close()
+            error = requests.HTTPError(str(returned_request.status_code) +
+                                       ' from ' + url)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as exception:
+            if spool is not None:
+                os.remove(spool.name)  # Cut off mid-body; start over.
+            error = exception
+        if attempt == FETCH_RETRIES:
+            raise error
+        print('Exception fetching ' + url + ', retrying...')
+        time.sleep(FETCH_BACKOFF * 2 ** attempt)
 
+
+def fetch_cached(url, params=None, ttl=0):
+    # A GET through the on-disk response cache, returning its entry: the
+    # body's 'path' and 'digest', plus the HTTP validators. The body file
+    # belongs to the cache and must not be removed.
+    cache = http_cache.HttpCache()
+    return cache.fetch(url, params, ttl, download, offline=HTTP_CACHE_OFFLINE)
+
+
+def fetch_covid_csv(covid_url):
+    return fetch_cached(covid_url, ttl=COVID_REFRESH_HOURS * 3600)
+
+
+def open_csv_stream(path):
+    return open(path, encoding='utf-8', newline='')
+
+
+def iter_covid_rows(reader, data_header, cutoff=''):
+    # Yields one converted row at a time so a whole file is never held in
+    # memory. Rows dated before cutoff are skipped.
+    int_indexes = [i for i, x in enumerate(data_header) if x in NYT_INT_LIST]
+    date_index = data_header.index('date')
+    for row in reader:
+        if not row or row[date_index] < cutoff:
+            continue
+        for i in int_indexes:
+            # The NYT leaves some county death counts blank.
+            row[i] = int(row[i]) if row[i] else 0
+        yield row
+
+
+def store_covid_csv(connection, cursor, table, csv_stream, schema=None):
+    # schema names the table whose generated columns to use, when loading
+    # into a differently named table such as a shadow. Doesn't commit.
+    reader = csv.reader(csv_stream)
+    data_header = next(reader)
+
+    # A plain INTEGER PRIMARY KEY rather than AUTOINCREMENT, which would
+    # update sqlite_sequence on every insert.
     cmd = ("CREATE TABLE " + table +
-           " ('ID' INTEGER PRIMARY KEY AUTOINCREMENT, ")
+           " ('ID' INTEGER PRIMARY KEY, ")
     cmd_list = list()
     for field in data_header:
         if field in NYT_INT_LIST:
             cmd_list.append(field + ' INTEGER NOT NULL')
         else:
             cmd_list.append(field + ' TEXT NOT NULL')
+    cmd_list += generated_column_sql(schema or table)
     cmd += ','.join(cmd_list) + ");"
 
     cursor.execute(cmd)
-    connection.commit()
 
-    table_data = list()
-    for line in data_lines:
-        table_data.append(tuple(line.split(',')))
-    cmd = ("INSERT INTO " + table +
-           " VALUES (NULL," + ','.join('?'*len(data_header)) + ");")
-    cursor.executemany(cmd, table_data)
+    cmd = ("INSERT INTO " + table + " (" + ','.join(data_header) +
+           ") VALUES (" + ','.join('?'*len(data_header)) + ");")
+    batches = iter_batches(iter_covid_rows(reader, data_header))
+    for batch in metrics.timed_batches(batches, schema or table):
+        with metrics.stage('insert', schema or table):
+            cursor.executemany(cmd, batch)
+
+    return data_header
+
+
+def iter_batches(rows):
+    while True:
+        batch = list(itertools.islice(rows, INGEST_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def create_covid_key_index(cursor, table, data_header):
+    # Every non-count column together identifies a row: (date) for us,
+    # (date, state, fips) for state and (date, county, state, fips) for
+    # county, since the NYT leaves fips blank for some county rows.
+    key_fields = [x for x in data_header if x not in NYT_INT_LIST]
+    cmd = ("CREATE UNIQUE INDEX IF NOT EXISTS " + table + "_key ON " +
+           table + " (" + ','.join(key_fields) + ");")
+    cursor.execute(cmd)
+
+
+def get_loaded_digest(cursor, url):
+    # Digest of the response body the table from url was last built from.
+    cmd = "SELECT digest FROM http_validators WHERE url=?;"
+    row = cursor.execute(cmd, (url,)).fetchone()
+    return None if row is None else row[0]
+
+
+def save_loaded_digest(cursor, url, source):
+    cmd = "INSERT OR REPLACE INTO http_validators VALUES (?,?);"
+    cursor.execute(cmd, (url, source['digest']))
+
+
+def touch_timings(connection, cursor, table):
+    cmd = "UPDATE timings SET timestamp=? WHERE tablename=?;"
+    cursor.execute(cmd, (datetime.datetime.now().isoformat(), table))
     connection.commit()
 
-    cmd = "INSERT INTO timings VALUES (?,?);"
-    cursor.execute(cmd, (table, datetime.datetime.now().isoformat()))
+
+def refresh_covid_data(connection, cursor, table, covid_url, fetched=None):
+    source = fetched or fetch_covid_csv(covid_url)
+
+    if source['digest'] == get_loaded_digest(cursor, covid_url):
+        touch_timings(connection, cursor, table)  # Unchanged since loaded.
+        return
+
+    with open_csv_stream(source['path']) as csv_stream:
+        since = upsert_covid_csv(connection, cursor, table, csv_stream)
+    if since is not None:
+        mark_data_changed(cursor, since)
+
+    save_loaded_digest(cursor, covid_url, source)
+    cmd = "UPDATE timings SET timestamp=? WHERE tablename=?;"
+    cursor.execute(cmd, (datetime.datetime.now().isoformat(), table))
     connection.commit()
 
     return
 
 
+def revision_cutoff(newest):
+    # Only rows on or after the newest stored date, less a window for
+    # revisions to recent days, can be new or changed.
+    if newest is None:
+        return ''
+    return (datetime.date.fromisoformat(newest) -
+            datetime.timedelta(days=REVISION_WINDOW_DAYS)).isoformat()
+
+
+def upsert_covid_csv(connection, cursor, table, csv_stream):
+    # Returns the first date of a batch with a changed row, or None when
+    # no row changed.
+    if table == 'county':
+        return upsert_county_csv(connection, cursor, csv_stream)
+    reader = csv.reader(csv_stream)
+    data_header = next(reader)
+    create_covid_key_index(cursor, table, data_header)
+
+    cmd = "SELECT max(date) FROM " + table + ";"
+    cutoff = revision_cutoff(cursor.execute(cmd).fetchone()[0])
+
+    key_fields = [x for x in data_header if x not in NYT_INT_LIST]
+    int_fields = [x for x in data_header if x in NYT_INT_LIST]
+    cmd = ("INSERT INTO " + table + " (" + ','.join(data_header) +
+           ") VALUES (" + ','.join('?'*len(data_header)) + ") " +
+           "ON CONFLICT (" + ','.join(key_fields) + ") DO UPDATE SET " +
+           ','.join(x + '=excluded.' + x for x in int_fields) + " WHERE " +
+           ' OR '.join(x + '<>excluded.' + x for x in int_fields) + ";")
+    # All writes below share one transaction, committed by the caller.
+    date = data_header.index('date')
+    since = None
+    batches = iter_batches(iter_covid_rows(reader, data_header, cutoff))
+    for batch in metrics.timed_batches(batches, table):
+        with metrics.stage('insert', table):
+            cursor.executemany(cmd, batch)
+        if cursor.rowcount:  # Unchanged rows don't count.
+            first = min(x[date] for x in batch)
+            since = first if since is None else min(since, first)
+
+    return since
+
+
+def upsert_county_csv(connection, cursor, csv_stream):
+    # upsert_covid_csv for county_store's tables.
+    reader = csv.reader(csv_stream)
+    data_header = next(reader)
+    cutoff = revision_cutoff(county_store.newest_date(cursor))
+    keys = county_store.CountyKeys(cursor)
+    rows = county_store.compact_rows(
+        iter_covid_rows(reader, data_header, cutoff), data_header, keys)
+    since = None
+    for batch in metrics.timed_batches(iter_batches(rows), 'county'):
+        with metrics.stage('insert', 'county'):
+            cursor.executemany(county_store.UPSERT, batch)
+        if cursor.rowcount:
+            first = county_store.day_date(min(x[1] for x in batch))
+            since = first if since is None else min(since, first)
+
+    return since
+
+
+def census_params(get_params, for_params):
+    # Without a local secrets.py the stdlib module is found instead; the
+    # Census API still answers small keyless requests, so no key is sent.
+    params = {'get': get_params, 'for': for_params}
+    if getattr(secrets, 'API_KEY', ''):
+        params['key'] = secrets.API_KEY
+    return params
+
+
 def make_census_call(base, get_params, for_params):
-    request_params = {'get': get_params,
-                      'for': for_params,
-                      'key': secrets.API_KEY}
-    return requests.get(base, request_params).text
+    return fetch_cached(base, census_params(get_params, for_params),
+                        ttl=CENSUS_REFRESH_DAYS * 24 * 3600)
 
 
-def load_census_data(connection, cursor, table, return_data):
-    data = json.loads(return_data)
-    data_header = [x.lower() for x in data.pop(0)]
+def iter_census_rows(census_stream):
+    # The Census API writes one row per line: '[["POP",...],' then
+    # '["123",...],' up to a last '["456",...]]', so rows can be parsed
+    # one at a time. A response on a single line is parsed whole.
+    first = census_stream.readline().strip()
+    if not first.endswith(','):
+        yield from json.loads(first + census_stream.read())
+        return
+    yield json.loads(first[1:-1])
+    for line in census_stream:
+        line = line.strip().rstrip(',')
+        if line.endswith(']]'):
+            line = line[:-1]
+        if line:
+            yield json.loads(line)
 
-    cmd = ("CREATE TABLE " + table +
-           " ('ID' INTEGER PRIMARY KEY AUTOINCREMENT, ")
-    cmd_list = list()
-    for field in data_header:
-        if field in CENSUS_INT_LIST:
-            cmd_list.append(field + ' INTEGER NOT NULL')
-        elif field in CENSUS_FLOAT_LIST:
-            cmd_list.append(field + ' REAL') #These are sometimes null.
-        else:
-            cmd_list.append(field + ' TEXT NOT NULL')
-    cmd += ','.join(cmd_list) + ");"
 
-    # print(data_header)
+def load_census_data(connection, cursor, table, path):
+    # One transaction, left open for the caller to commit, like
+    # load_covid_file.
+    begin_load(connection, cursor, table)
+    try:
+        with open(path, encoding='utf-8') as census_stream:
+            rows = iter_census_rows(census_stream)
+            data_header = [x.lower() for x in next(rows)]
 
-    cursor.execute(cmd)
-    connection.commit()
+            cmd = ("CREATE TABLE " + table + "_shadow" +
+                   " ('ID' INTEGER PRIMARY KEY, ")
+            cmd_list = list()
+            for field in data_header:
+                if field in CENSUS_INT_LIST:
+                    cmd_list.append(field + ' INTEGER NOT NULL')
+                elif field in CENSUS_FLOAT_LIST:
+                    cmd_list.append(field + ' REAL') #These are sometimes null.
+                else:
+                    cmd_list.append(field + ' TEXT NOT NULL')
+            cmd_list += generated_column_sql(table)
+            cmd += ','.join(cmd_list) + ");"
 
-    table_data = list()
-    for row in data:
-        table_data.append(tuple(row))
-    cmd = ("INSERT INTO " + table +
-           " VALUES (NULL," + ','.join('?'*len(data_header)) + ");")
-    cursor.executemany(cmd, table_data)
-    connection.commit()
+            # print(data_header)
 
-    cmd = "INSERT INTO timings VALUES (?,?);"
-    # test = tuple([table, 'now'])
-    # print(test)
-    cursor.execute(cmd, (table, datetime.datetime.now().isoformat()))
-    connection.commit()
+            cursor.execute(cmd)
+
+            cmd = ("INSERT INTO " + table + "_shadow" +
+                   " VALUES (NULL," + ','.join('?'*len(data_header)) + ");")
+            for batch in metrics.timed_batches(iter_batches(rows), table):
+                with metrics.stage('insert', table):
+                    cursor.executemany(cmd, batch)
+
+        with metrics.stage('index', table):
+            swap_in_shadow(cursor, table)
+            cursor.execute("ANALYZE " + table + ";")
+    except BaseException:
+        connection.rollback()
+        raise
 
     return
 
 
-def get_census_data(connection, cursor, timings, table, census_url, get_params, for_params):
-    if table not in timings.keys():
-        return_text = make_census_call(CENSUS_POP_BASE, get_params, for_params)
-        load_census_data(connection, cursor, table, return_text)
+def get_census_data(connection, cursor, timings, table, census_url, get_params, for_params,
+                    fetched=None):
+    refresh_time = (datetime.datetime.now() -
+                    datetime.timedelta(days=CENSUS_REFRESH_DAYS))
+    if table not in timings.keys() or timings[table] < refresh_time:
+        source = fetched or make_census_call(census_url, get_params,
+                                             for_params)
+        url = http_cache.request_key(census_url,
+                                     census_params(get_params, for_params))
+        if (table in timings.keys()
+                and source['digest'] == get_loaded_digest(cursor, url)):
+            touch_timings(connection, cursor, table)  # Unchanged.
+        else:
+            load_census_data(connection, cursor, table, source['path'])
+            save_loaded_digest(cursor, url, source)
+            connection.commit()
         timings = get_table_timings(connection, cursor)
 
-    cmd = "SELECT * FROM " + table + ";"
-    data = cursor.execute(cmd).fetchall()
+    return timings
+
+
+def get_geo_assets(connection, cursor):
+    # County shapes change far less often than census estimates, and are
+    # only turned into the map assets again when the download differs.
+    try:
+        source = fetch_cached(COUNTY_GEOJSON_URL,
+                              ttl=CENSUS_REFRESH_DAYS * 24 * 3600)
+    except (requests.RequestException, http_cache.CacheMiss) as exception:
+        print('Could not fetch map shapes: ' + str(exception))
+        return
+    if (geo.assets_exist()
+            and source['digest'] == get_loaded_digest(cursor,
+                                                      COUNTY_GEOJSON_URL)):
+        return
+    geo.build_geo_assets(source['path'])
+    save_loaded_digest(cursor, COUNTY_GEOJSON_URL, source)
+    connection.commit()
+
+
+def plan_fetches(timings):
+    # Works out which sources get_covid_data/get_census_data will need,
+    # as {table: (function, args)}, so they can be fetched up front.
+    refresh_time = (datetime.datetime.now() -
+                    datetime.timedelta(hours=COVID_REFRESH_HOURS))
+    census_refresh_time = (datetime.datetime.now() -
+                           datetime.timedelta(days=CENSUS_REFRESH_DAYS))
+    fetches = dict()
+    for table, filename in COVID_SOURCES:
+        if table not in timings.keys() or timings[table] < refresh_time:
+            fetches[table] = (fetch_covid_csv, (NYT_COVID19_BASE + filename,))
+    for table, get_params, for_params in CENSUS_SOURCES:
+        if (table not in timings.keys()
+                or timings[table] < census_refresh_time):
+            fetches[table] = (make_census_call,
+                              (CENSUS_POP_BASE, get_params, for_params))
+    return fetches
+
+
+def timed_fetch(table, function, args):
+    with metrics.stage('download', table):
+        return function(*args)
+
+
+def fetch_all(fetches):
+    # Runs every fetch at once; the total time is roughly the slowest one.
+    # A source that still fails after its retries is left out, and its
+    # table keeps the data it already has.
+    fetched = dict()
+    if not fetches:
+        return fetched
+    with concurrent.futures.ThreadPoolExecutor(FETCH_WORKERS) as executor:
+        futures = {table: executor.submit(timed_fetch, table, function, args)
+                   for table, (function, args) in fetches.items()}
+    for table, future in futures.items():
+        try:
+            fetched[table] = future.result()
+        except (requests.RequestException, http_cache.CacheMiss) as exception:
+            print('Could not fetch ' + table + ': ' + str(exception))
+    return fetched
+
+
+# Latest-date snapshots joined with census data, so the comparison pages
+# can rank states/counties with a single indexed lookup. Census is the
+# base of each join, matching which fips the pages know names for.
+LATEST_COLUMNS = ("cases INTEGER, deaths INTEGER, pop INTEGER, " +
+                  "density REAL, cases_per_100k REAL, deaths_per_100k REAL, " +
+                  "avg_cases REAL, avg_deaths REAL, avg_cases_per_100k REAL, " +
+                  "doubling_days REAL, cfr REAL")
+LATEST_SELECT = ("I.cases, I.deaths, Cen.pop, Cen.density, " +
+                 "I.cases_per_100k, I.deaths_per_100k, I.avg_cases, " +
+                 "I.avg_deaths, I.avg_cases_per_100k, I.doubling_days, I.cfr")
+# Each state's county rows added up by date. Walking county_keys reaches
+# each county's days through the primary key, so the days from :day on
+# are read without a scan.
+COUNTY_TOTALS_SELECT = ("SELECT Cen.state, date(C.day*86400,'unixepoch'), " +
+                        "count(*), sum(C.cases), sum(C.deaths), " +
+                        "sum(Cen.pop), " +
+                        "round(sum(C.cases)*100000.0/" +
+                        "nullif(sum(Cen.pop),0),2), " +
+                        "round(sum(C.deaths)*100000.0/" +
+                        "nullif(sum(Cen.pop),0),2) " +
+                        "FROM county_keys AS K " +
+                        "INNER JOIN county_compact AS C " +
+                        "ON C.county_id=K.county_id " +
+                        "INNER JOIN county_census AS Cen " +
+                        "ON Cen.county_fips=K.fips")
+COUNTY_TOTALS_GROUP = " GROUP BY Cen.state, C.day"
+# A rollup with 'refresh' has rows by date. After an upsert, build_rollups
+# deletes and selects again only the rows from the first date it changed,
+# given as :date and as its county day number, :day.
+ROLLUP_TABLES = {
+    'state_latest': {
+        'sources': ['state_indicators', 'state_census'],
+        'schema': ("(fips TEXT PRIMARY KEY, date TEXT, " + LATEST_COLUMNS +
+                   ")"),
+        'select': ("SELECT Cen.state, I.date, " + LATEST_SELECT + " " +
+                   "FROM state_census as Cen LEFT JOIN state_indicators as I " +
+                   "ON I.fips=Cen.state AND " +
+                   "I.date=(SELECT max(date) FROM state_indicators)"),
+    },
+    'county_latest': {  # Read from the compact table, by each fips' id.
+        'sources': ['county_indicators', 'county_census'],
+        'schema': ("(fips TEXT PRIMARY KEY, state_fips TEXT, date TEXT, " +
+                   LATEST_COLUMNS + ")"),
+        'select': ("SELECT Cen.county_fips, Cen.state, " +
+                   "date(I.day*86400,'unixepoch'), " + LATEST_SELECT + " " +
+                   "FROM county_census as Cen " +
+                   "LEFT JOIN county_indicators_compact as I " +
+                   "ON I.county_id=(SELECT min(county_id) " +
+                   "FROM county_keys WHERE fips=Cen.county_fips) AND " +
+                   "I.day=(SELECT max(day) FROM county_indicators_compact)"),
+    },
+    'county_totals_by_state': {
+        'sources': ['county', 'county_census'],
+        'schema': ("(state_fips TEXT, date TEXT, counties INTEGER, " +
+                   "cases INTEGER, deaths INTEGER, pop INTEGER, " +
+                   "cases_per_100k REAL, deaths_per_100k REAL, " +
+                   "PRIMARY KEY (state_fips, date)) WITHOUT ROWID"),
+        'select': COUNTY_TOTALS_SELECT + COUNTY_TOTALS_GROUP,
+        'refresh': ("DELETE FROM county_totals_by_state WHERE date>=:date",
+                    COUNTY_TOTALS_SELECT + " WHERE C.day>=:day" +
+                    COUNTY_TOTALS_GROUP),
+    },
+    # The catalog tables hold what the pages' dropdowns list, so the app
+    # never has to scan the data tables for them.
+    'catalog_dates': {
+        'sources': ['us', 'state', 'county'],
+        'schema': ("(level TEXT, date TEXT, PRIMARY KEY (level, date)) " +
+                   "WITHOUT ROWID"),
+        'select': ("SELECT DISTINCT 'us', date FROM us UNION ALL " +
+                   "SELECT DISTINCT 'state', date FROM state UNION ALL " +
+                   "SELECT DISTINCT 'county', " +
+                   "date(day*86400,'unixepoch') FROM county_compact"),
+        'refresh': ("DELETE FROM catalog_dates WHERE date>=:date",
+                    "SELECT DISTINCT 'us', date FROM us " +
+                    "WHERE date>=:date UNION ALL " +
+                    "SELECT DISTINCT 'state', date FROM state " +
+                    "WHERE date>=:date UNION ALL " +
+                    "SELECT DISTINCT 'county', " +
+                    "date(C.day*86400,'unixepoch') FROM county_keys AS K " +
+                    "INNER JOIN county_compact AS C " +
+                    "ON C.county_id=K.county_id WHERE C.day>=:day"),
+    },
+    'catalog_places': {  # States and counties that have both data and names.
+        'sources': ['state', 'county', 'state_census', 'county_census'],
+        'schema': ("(level TEXT, fips TEXT, state_fips TEXT, name TEXT, " +
+                   "PRIMARY KEY (level, fips)) WITHOUT ROWID"),
+        'select': ("SELECT 'state', state, state, name FROM state_census " +
+                   "WHERE state IN (SELECT DISTINCT fips FROM state) " +
+                   "UNION ALL SELECT 'county', county_fips, state, " +
+                   "substr([name],0,instr([name],',')) FROM county_census " +
+                   "WHERE county_fips IN (SELECT fips FROM county_keys)"),
+    },
+}
+
+
+def build_indicators(connection, cursor, timings):
+    # Rebuilt, like the rollups, only when data has changed since the last
+    # published version, or when they don't exist yet.
+    cmd = "SELECT pending FROM data_version;"
+    pending = cursor.execute(cmd).fetchone()[0]
+    for level, (census_table, census_query) in INDICATOR_SOURCES.items():
+        table = level + '_indicators'
+        if level not in timings or census_table not in timings:
+            continue
+        if table in timings and not pending:
+            continue
+
+        census = {x[0]: (x[1], x[2])
+                  for x in cursor.execute(census_query).fetchall()}
+        data = series_store.read_level(cursor, level)
+        stored, names, key = indicators.stored_table(level)
+        begin_load(connection, cursor, stored)
+        try:
+            create_indicator_shadow(cursor, level)
+            if data is not None:
+                columns = indicators.compute_indicators(*data, census)
+                if level == 'county':
+                    cmd = county_store.FIPS_IDS
+                    ids = dict(cursor.execute(cmd).fetchall())
+                    indicators.add_county_ids(columns, data[2], ids)
+                cmd = ("INSERT INTO " + stored + "_shadow VALUES (" +
+                       ','.join('?'*len(names)) + ");")
+                for start in range(0, len(data[0]), INGEST_BATCH_SIZE):
+                    cursor.executemany(cmd, indicators.indicator_rows(
+                        columns, start, start + INGEST_BATCH_SIZE, names))
+            swap_in_shadow(cursor, stored)
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    return get_table_timings(connection, cursor)
+
+
+def create_indicator_shadow(cursor, level):
+    table, names, key = indicators.stored_table(level)
+    cmd = ("CREATE TABLE " + table + "_shadow (" +
+           ','.join(x + ' ' + y for x, y in names) +
+           ", PRIMARY KEY (" + key + ")) WITHOUT ROWID;")
+    cursor.execute(cmd)
+
+
+def build_rollups(connection, cursor, timings):
+    # Rollups are rebuilt only when data has changed since the last
+    # published version, or when they don't exist yet.
+    cmd = "SELECT pending, since FROM data_version;"
+    pending, since = cursor.execute(cmd).fetchone()
+    for table, rollup in ROLLUP_TABLES.items():
+        if not all(x in timings for x in rollup['sources']):
+            continue
+        if table in timings and not pending:
+            continue
+
+        if table in timings and since and 'refresh' in rollup:
+            refresh_rollup(connection, cursor, table, rollup, since)
+            continue
+
+        # Built afresh with the current columns, then swapped in.
+        begin_load(connection, cursor, table)
+        try:
+            cursor.execute("CREATE TABLE " + table + "_shadow " +
+                           rollup['schema'] + ";")
+            cursor.execute("INSERT INTO " + table + "_shadow " +
+                           rollup['select'] + ";")
+            swap_in_shadow(cursor, table)
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    return get_table_timings(connection, cursor)
+
 
-    return timings, data
+def refresh_rollup(connection, cursor, table, rollup, since):
+    # Replaces the rows of the rollup from since on, in place.
+    parameters = {'date': since, 'day': county_store.day_number(since)}
+    connection.commit()
+    cursor.execute("BEGIN;")
+    try:
+        cursor.execute(rollup['refresh'][0] + ";", parameters)
+        cursor.execute("INSERT INTO " + table + " " + rollup['refresh'][1] +
+                       ";", parameters)
+        cmd = "UPDATE timings SET timestamp=? WHERE tablename=?;"
+        cursor.execute(cmd, (datetime.datetime.now().isoformat(), table))
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+
+def save_catalog_snapshot(cursor, version):
+    # The pages' dropdowns and names, for the app to start from. Written
+    # after every run, whatever version the file already has: it is cheap,
+    # and SNAPSHOT=1 serves it as it is.
+    try:
+        catalog.write_snapshot(cursor, version)
+    except sqlite3.OperationalError:
+        pass  # No catalog tables until the first successful load.
+
+
+def write_snapshot(directory):
+    # Everything the app serves from, copied into directory to be shipped
+    # to a new container and served with SNAPSHOT=1 from inside it: the
+    # database compacted by VACUUM INTO, the catalog, and the series and
+    # map caches. Served that way, the app starts without ingesting,
+    # refreshing or locking anything.
+    os.makedirs(directory, exist_ok=True)
+    database = os.path.join(directory,
+                            os.path.basename(PROJECT_DATABASE_NAME))
+    if os.path.exists(database):
+        os.remove(database)
+    conn = sqlite3.connect(PROJECT_DATABASE_NAME)
+    cur = conn.cursor()
+    cur.execute("VACUUM INTO ?;", (database,))
+    catalog.write_snapshot(cur, get_data_version(cur),
+                           os.path.join(directory, catalog.CATALOG_SNAPSHOT))
+    conn.close()
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode=DELETE;")  # No -wal or -shm files.
+    conn.close()
+    for cache in [series_store.SERIES_CACHE_DIR, geo.GEO_DIR]:
+        target = os.path.join(directory, cache)
+        shutil.rmtree(target, ignore_errors=True)
+        if os.path.exists(cache):
+            shutil.copytree(cache, target)
 
 
 def main_data_setup():
+    start = time.perf_counter()
+    metrics.ingest.clear()
     conn = sqlite3.connect(PROJECT_DATABASE_NAME)
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
+    # WAL lets the web app's readers keep going while we write.
+    cur.execute("PRAGMA journal_mode=WAL;")
+
+    get_table_timings(conn, cur)
+    migrate_schema(conn, cur)
+    table_timings = get_table_timings(conn, cur)  # After any migrations.
+
+    fetches = plan_fetches(table_timings)
+    fetched = fetch_all(fetches)
+    with bulk_load(cur):
+        for table, filename in COVID_SOURCES:
+            if table in fetches and table not in fetched:
+                continue
+            table_timings = get_covid_data(conn, cur, table_timings, table,
+                                           NYT_COVID19_BASE + filename,
+                                           fetched=fetched.get(table))
+        for table, get_params, for_params in CENSUS_SOURCES:
+            if table in fetches and table not in fetched:
+                continue
+            table_timings = get_census_data(conn, cur, table_timings, table,
+                                            CENSUS_POP_BASE, get_params,
+                                            for_params,
+                                            fetched=fetched.get(table))
+        with metrics.stage('indicators'):
+            table_timings = build_indicators(conn, cur, table_timings)
+        with metrics.stage('rollups'):
+            table_timings = build_rollups(conn, cur, table_timings)
+    version = publish_data_version(conn, cur)
+    save_catalog_snapshot(cur, version)
+    with metrics.stage('series'):
+        series_store.build_series_store(cur, version)
+        cross_section.build_cross_sections(cur, version)
+    with metrics.stage('geo'):
+        get_geo_assets(conn, cur)
 
-    table_timings = get_table_timings(conn, cur)
-    table_timings, covid_us = get_covid_data(conn, cur, table_timings, 'us',
-                                             NYT_COVID19_BASE + 'us.csv')
-    table_timings, covid_state = get_covid_data(conn, cur, table_timings, 'state',
-                                                NYT_COVID19_BASE + 'us-states.csv')
-    table_timings, covid_county = get_covid_data(conn, cur, table_timings, 'county',
-                                                 NYT_COVID19_BASE + 'us-counties.csv')
-
-    table_timings, census_us = get_census_data(conn, cur, table_timings, 'us_census',
-                                               CENSUS_POP_BASE, 'POP,DENSITY', 'us:*')
-    table_timings, census_state = get_census_data(conn, cur, table_timings, 'state_census',
-                                                  CENSUS_POP_BASE, 'POP,DENSITY,NAME', 'state:*')
-    table_timings, census_county = get_census_data(conn, cur, table_timings, 'county_census',
-                                                   CENSUS_POP_BASE, 'POP,DENSITY,NAME', 'county:*')
-
-    conn.close()                                                   
-    # return (covid_us, covid_state, covid_county, census_us, census_state, census_county)
+    conn.close()
+    metrics.write_ingest_metrics(time.perf_counter() - start)
     return
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build or refresh the data.')
+    parser.add_argument('--snapshot', metavar='DIRECTORY',
+                        help='then write a snapshot to serve from there')
+    args = parser.parse_args()
     main_data_setup()
+    if args.snapshot:
+        write_snapshot(args.snapshot)
 
     print('Exiting...')
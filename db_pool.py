@@ -0,0 +1,58 @@
+import os
+import queue
+import sqlite3
+
+import metrics
+
+
+READ_CACHE_KIB = 64 * 1024  # Page cache per connection (PRAGMA cache_size).
+READ_MMAP_BYTES = 256 * 1024 * 1024  # Memory-mapped I/O window per connection.
+
+
+class ConnectionPool:
+    # Hands out read-only connections for the Flask routes. The database is
+    # kept in WAL mode by data_setup, so these readers never block on (or
+    # block) an ingest that is writing at the same time. An immutable
+    # database, such as a snapshot nothing writes to, is read without any
+    # locking at all.
+
+    def __init__(self, database, size=8, immutable=False):
+        self.database = database
+        self.size = size
+        self.immutable = immutable
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue(maxsize=self.size)
+
+    def connect(self):
+        uri = 'file:' + self.database + '?mode=ro'
+        if self.immutable:
+            uri += '&immutable=1'
+        conn = sqlite3.connect(uri, uri=True,
+                               check_same_thread=False,
+                               factory=metrics.connection_factory())
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA cache_size=-' + str(READ_CACHE_KIB) + ';')
+        conn.execute('PRAGMA mmap_size=' + str(READ_MMAP_BYTES) + ';')
+        return conn
+
+    def acquire(self):
+        if self.pid != os.getpid():
+            # Connections must never cross a fork; drop the parent's.
+            self._reset()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, conn):
+        if self.pid != os.getpid():
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
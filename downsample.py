@@ -0,0 +1,78 @@
+import lazy
+
+np = lazy.LazyModule('numpy')
+
+
+RESOLUTIONS = ['daily', 'weekly', 'monthly']
+# Columns whose buckets add up; every other column keeps its last value,
+# which is the right thing for running totals and rolling averages.
+SUM_COLUMNS = ['new_cases', 'new_deaths']
+
+
+# Works on series in the series_store layout: a dict of equal length
+# arrays with a sorted 'date' column.
+
+def clip(series, start=None, end=None):
+    # Rows with start <= date <= end; either bound may be None.
+    dates = series['date']
+    lo = 0 if start is None else np.searchsorted(dates, start, 'left')
+    hi = len(dates) if end is None else np.searchsorted(dates, end, 'right')
+    return {x: y[lo:hi] for x, y in series.items()}
+
+
+def bucket(series, resolution):
+    # Aggregates daily rows into weeks (starting Monday) or months, each
+    # labelled with the last date it has data for.
+    dates = series['date']
+    if resolution == 'daily' or len(dates) == 0:
+        return series
+    if resolution == 'weekly':
+        # Day 0 of datetime64 is a Thursday; shift so weeks start Monday.
+        keys = (dates.astype(np.int64) + 3) // 7
+    else:
+        keys = dates.astype('datetime64[M]')
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    lasts = np.r_[starts[1:], len(dates)] - 1
+    bucketed = dict()
+    for column, values in series.items():
+        if column in SUM_COLUMNS:
+            bucketed[column] = np.add.reduceat(values, starts)
+        else:
+            bucketed[column] = values[lasts]
+    return bucketed
+
+
+def lttb_indices(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: the threshold points that best keep
+    # the visual shape of the line. Always keeps the first and last point.
+    size = len(y)
+    if threshold >= size or threshold < 3:
+        return np.arange(size)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.int64)
+    edges = np.r_[edges, size]
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, size - 1
+    chosen = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_x = x[hi:edges[i + 2]].mean()
+        next_y = y[hi:edges[i + 2]].mean()
+        area = np.abs((x[chosen] - next_x) * (y[lo:hi] - y[chosen])
+                      - (x[chosen] - x[lo:hi]) * (next_y - y[chosen]))
+        chosen = lo + int(area.argmax())
+        indices[i + 1] = chosen
+    return indices
+
+
+def downsample(series, start=None, end=None, resolution='daily',
+               max_points=None, key='cases'):
+    # Range, then resolution, then at most max_points rows picked by LTTB
+    # on the key column.
+    series = bucket(clip(series, start, end), resolution)
+    if max_points is not None and len(series['date']) > max_points:
+        keep = lttb_indices(series['date'].astype(np.int64), series[key],
+                            max_points)
+        series = {x: y[keep] for x, y in series.items()}
+    return series
@@ -0,0 +1,145 @@
+import csv
+import io
+import json
+
+import indicators
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Optional; only needed for Parquet exports.
+    pyarrow = None
+
+
+# Bulk exports of the <level>_indicators tables, which hold each day's NYT
+# counts joined with the place's census population and density, plus the
+# census name. Rows are streamed from a sqlite cursor EXPORT_BATCH_ROWS at
+# a time and written out batch by batch, so a full county export never
+# holds more than one batch in memory.
+EXPORT_LEVELS = ['us', 'state', 'county']
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson',
+                  'parquet': 'application/vnd.apache.parquet'}
+EXPORT_BATCH_ROWS = 5000
+EXPORT_COLUMNS = (['fips', 'name', 'date'] +
+                  [x for x, y in indicators.INDICATOR_COLUMNS
+                   if x not in ['fips', 'date']])
+ARROW_TYPES = {'TEXT': 'string', 'INTEGER': 'int64', 'REAL': 'float64'}
+NAME_JOINS = {
+    'us': ("'United States'", ""),
+    'state': ("C.name", " LEFT JOIN state_census AS C ON C.state=I.fips"),
+    'county': ("C.name",
+               " LEFT JOIN county_census AS C ON C.county_fips=I.fips"),
+}
+
+
+def formats():
+    # The formats this process can write.
+    return [x for x in EXPORT_FORMATS
+            if x != 'parquet' or pyarrow is not None]
+
+
+def export_query(level, state=None, start=None, end=None):
+    # (sql, parameters) for the level's rows in (fips, date) order, which
+    # is the table's primary key order, so sqlite never sorts more than
+    # one county's days at a time. A state limits counties to those whose
+    # fips start with it.
+    name, join = NAME_JOINS[level]
+    columns = ['I.' + x if x != 'name' else name + ' AS name'
+               for x in EXPORT_COLUMNS]
+    cmd = ("SELECT " + ','.join(columns) + " FROM " + level +
+           "_indicators AS I" + join)
+    conditions, parameters = list(), list()
+    if state is not None:
+        conditions.append("I.fips GLOB ?")
+        parameters.append(state + '*')
+    if start is not None:
+        conditions.append("I.date>=?")
+        parameters.append(start)
+    if end is not None:
+        conditions.append("I.date<=?")
+        parameters.append(end)
+    if conditions:
+        cmd += " WHERE " + " AND ".join(conditions)
+    return cmd + " ORDER BY I.fips, I.date;", parameters
+
+
+def iter_batches(cursor, query):
+    cursor.execute(*query)
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_ROWS)
+        if not rows:
+            return
+        yield rows
+
+
+def write_csv(batches):
+    yield (','.join(EXPORT_COLUMNS) + '\r\n').encode()
+    for rows in batches:
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        yield text.getvalue().encode()
+
+
+def write_ndjson(batches):
+    # sqlite has already turned NaN into NULL, so every value is valid JSON.
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    for rows in batches:
+        yield ''.join(encode(dict(zip(EXPORT_COLUMNS, x))) + '\n'
+                      for x in rows).encode()
+
+
+class StreamSink(io.RawIOBase):
+    # A write-only file for pyarrow that keeps what was written until it
+    # is drained, while still reporting the full stream's position, which
+    # Parquet records in its footer.
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = list()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = list()
+        return data
+
+
+def arrow_schema():
+    kinds = dict(indicators.INDICATOR_COLUMNS, name='TEXT')
+    return pyarrow.schema([(x, getattr(pyarrow, ARROW_TYPES[kinds[x]])())
+                           for x in EXPORT_COLUMNS])
+
+
+def write_parquet(batches):
+    # Each batch becomes one Arrow record batch and one row group.
+    schema = arrow_schema()
+    sink = StreamSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        values = list(zip(*rows))
+        writer.write_batch(pyarrow.record_batch(
+            [pyarrow.array(x, type=y.type) for x, y in zip(values, schema)],
+            schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'csv': write_csv, 'ndjson': write_ndjson,
+           'parquet': write_parquet}
+
+
+def stream_export(cursor, level, fmt, state=None, start=None, end=None):
+    # The export as a generator of byte chunks.
+    batches = iter_batches(cursor, export_query(level, state, start, end))
+    return WRITERS[fmt](batches)
@@ -1,62 +1,391 @@
-import sqlite3
-import plotly.graph_objs as go
+import functools
+import gc
+import gzip
+import hashlib
+import json
+import os
+import catalog
+import cross_section
 import data_setup
-from flask import Flask, render_template, request, redirect, url_for
+import db_pool
+import downsample
+import export
+import geo
+import lazy
+import metrics
+import page_cache
+import refresh_scheduler
+import search
+import series_store
+from flask import (Flask, Blueprint, Response, render_template, request,
+                   redirect, url_for, g, jsonify, make_response, abort,
+                   before_render_template, template_rendered)
+try:
+    import brotli
+except ImportError:  # Optional; responses fall back to gzip.
+    brotli = None
+
+# Imported on the first request that needs them; see lazy.
+np = lazy.LazyModule('numpy')
+plotly = lazy.LazyModule('plotly')
+
+
+TABLE_ORDER = ['date', 'cases', 'deaths', 'new_cases', 'new_deaths',
+               'avg_cases', 'avg_deaths', 'cases_per_100k', 'deaths_per_100k',
+               'avg_cases_per_100k', 'doubling_days', 'cfr', 'pop', 'density']
+TABLE_NAMES = ['Date', 'Positive Tests', 'Deaths', 'New Cases', 'New Deaths',
+               'New Cases (7 Day Avg)', 'New Deaths (7 Day Avg)',
+               'Cases per 100k', 'Deaths per 100k',
+               'New Cases per 100k (7 Day Avg)', 'Doubling Time (Days)',
+               'Case Fatality Rate (%)', 'Population', 'Population Density']
+# The columns of county_totals_by_state shown on a state's page.
+COUNTY_TOTALS_NAMES = {'counties': 'Counties Reporting',
+                       'cases': 'Cases in Counties',
+                       'deaths': 'Deaths in Counties',
+                       'cases_per_100k': 'County Cases per 100k',
+                       'deaths_per_100k': 'County Deaths per 100k'}
+US_GRAPH_TITLES = {'both': 'Number of Cases/Deaths',
+                   'cases': 'Number of Cases', 'deaths': 'Number of Deaths'}
+COMPARE_COUNTS = [5, 10, 25, 50]  # Series a comparison page may plot.
+COMPARE_NAMES = {'cases': 'Cases', 'deaths': 'Deaths', 'pop': 'Population',
+                 'density': 'Density', 'cases_per_100k': 'Cases per 100k',
+                 'deaths_per_100k': 'Deaths per 100k',
+                 'avg_cases_per_100k': 'New Cases per 100k',
+                 'doubling_days': 'Doubling Time',
+                 'cfr': 'Case Fatality Rate'}
+API_MAX_AGE = 300  # Seconds clients may reuse API and page responses.
+COMPRESS_MIN_BYTES = 1024  # Smaller responses aren't worth compressing.
+CHART_MAX_POINTS = 500  # Points per line the graph pages ask the API for.
+SERIES_API_COLUMNS = (series_store.SERIES_COLUMNS +
+                      series_store.DERIVED_COLUMNS)
+MAP_NAMES = {'cases': 'Cases', 'deaths': 'Deaths',
+             'new_cases': 'New Cases', 'new_deaths': 'New Deaths',
+             'avg_cases': 'New Cases (7 Day Avg)',
+             'avg_deaths': 'New Deaths (7 Day Avg)',
+             'cases_per_100k': 'Cases per 100k',
+             'deaths_per_100k': 'Deaths per 100k',
+             'avg_cases_per_100k': 'New Cases per 100k (7 Day Avg)',
+             'doubling_days': 'Doubling Time (Days)',
+             'cfr': 'Case Fatality Rate (%)'}
+GEO_MAX_AGE = 24 * 3600  # Map shapes change at most once per census refresh.
+# SNAPSHOT=1 serves a directory written by data_setup.py --snapshot, from
+# inside it, as is: the database is opened immutable and never refreshed.
+SNAPSHOT = os.environ.get('SNAPSHOT') == '1'
+
+
+# Shared by every app from create_app(). Each is filled lazily on first
+# use and is safe to carry across a fork: the pool drops connections made
+# before it, and the rest are read-only or per-process caches.
+views = Blueprint('views', __name__)
+pool = db_pool.ConnectionPool(data_setup.PROJECT_DATABASE_NAME,
+                              immutable=SNAPSHOT)
+pages = page_cache.PageCache()
+series = series_store.SeriesStore()
+metadata = catalog.Catalog()
+place_search = search.PlaceSearch()
+plotly_bundles = dict()  # Compressed plotly.js, keyed on encoding.
+geo_assets = dict()  # {(level, encoding): (mtime, compressed shapes)}
+
+
+def get_db():
+    # One pooled connection per request, returned in release_db.
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def get_data_version():
+    if 'data_version' not in g:
+        g.data_version = data_setup.get_data_version(get_db().cursor())
+    return g.data_version
+
+
+def get_catalog():
+    # Dropdown dates, places and names for the current data version.
+    return metadata.get(get_db().cursor(), get_data_version())
+
+
+def get_place_index():
+    return place_search.get(get_catalog(), get_data_version())
+
+
+def place_name(names, fips):
+    # The catalog's name of a place, from its 'state_names' or
+    # 'county_names', with a 404 for a fips it doesn't list.
+    name = get_catalog()[names].get(fips)
+    if name is None:
+        abort(404)
+    return name
+
+
+def get_place(level, field, state=None):
+    # The fips an autocomplete field submitted, or with scripts off, the
+    # best match for the name typed into it.
+    fips = request.form.get(field)
+    if fips:
+        return fips
+    matches = get_place_index().search(request.form.get(field + '_name', ''),
+                                       1, level, state)
+    if not matches:
+        abort(404)
+    return matches[0]['fips']
+
+
+def get_series(level, fips):
+    # The series as a dict of arrays from the columnar store, or from
+    # sqlite if the store hasn't caught up with the current data yet.
+    data = series.get(level, fips, get_data_version())
+    if data is None:
+        data = series_store.query_series(get_db().cursor(), level, fips)
+    return data
+
+
+def get_series_batch(level, fips_list):
+    # Like get_series for several fips, as a dict keyed on fips.
+    data = series.get_many(level, fips_list, get_data_version())
+    if data is None:
+        data = series_store.query_series_batch(get_db().cursor(), level,
+                                               fips_list)
+    return data
+
+
+def get_compare_count():
+    count = request.args.get('count', COMPARE_COUNTS[0], type=int)
+    return min(max(count, 1), COMPARE_COUNTS[-1])
+
+
+def parse_comparison(comparison, yaxis):
+    # (compare_var, order) for a valid comparison like 'cases_per_100k_desc',
+    # otherwise None.
+    compare_var, _, order = comparison.rpartition('_')
+    if (compare_var not in COMPARE_NAMES or order not in ['asc', 'desc']
+            or yaxis not in data_setup.NYT_INT_LIST):
+        return None
+    return compare_var, order
+
+
+def rank_query(compare_var, order, state=None):
+    # Read through the rollup's index on compare_var; see
+    # data_setup.RANK_COLUMNS.
+    if state is None:
+        return ('SELECT fips FROM state_latest WHERE ' + compare_var
+                + ' IS NOT NULL ORDER BY ' + compare_var + ' ' + order
+                + ' LIMIT ?;')
+    return ('SELECT fips FROM county_latest WHERE state_fips=? AND '
+            + compare_var + ' IS NOT NULL ORDER BY ' + compare_var + ' '
+            + order + ' LIMIT ?;')
+
 
-
-TABLE_ORDER = ['date', 'cases', 'deaths', 'pop', 'density']
-TABLE_NAMES = ['Date', 'Positive Tests',
-               'Deaths', 'Population', 'Population Density']
+def rank_fips(compare_var, order, count, state=None):
+    # Top states, or counties within state, on the latest day's values.
+    cur = get_db().cursor()
+    query = rank_query(compare_var, order, state)
+    if state is None:
+        rows = cur.execute(query, tuple([count])).fetchall()
+    else:
+        rows = cur.execute(query, tuple([state, count])).fetchall()
+    return [x['fips'] for x in rows]
 
 
-app = Flask(__name__)
+def date_query(level):
+    # A place's indicators on one date; the us level's fips is ''.
+    return 'SELECT * FROM ' + level + '_indicators WHERE fips=? AND date=?;'
 
 
-@app.route('/')
-@app.route('/index')
-@app.route('/index.html')
-def index():
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+def county_totals_query():
+    # A state's county rows added up, on one date.
+    return ('SELECT * FROM county_totals_by_state ' +
+            'WHERE state_fips=? AND date=?;')
 
-    query = 'SELECT DISTINCT fips FROM state ORDER BY fips;'
-    states = cur.execute(query).fetchall()
-    conn.close()
 
-    return render_template('index.html',
-                           states=[x['fips'] for x in states],
-                           state_dict=state_dict)
+def compare_metric(compare_var, order, yaxis, places):
+    metric = COMPARE_NAMES[compare_var]
+    if order == 'asc':
+        metric = ' by ' + places + ' with Lowest ' + metric
+    else:
+        metric = ' by ' + places + ' with Highest ' + metric
+
+    return yaxis[0].upper() + yaxis[1:] + metric
+
+
+def get_window():
+    # The start, end, resolution and max_points arguments of the series
+    # API, as keyword arguments for downsample.downsample.
+    try:
+        start, end = [None if request.args.get(x) is None
+                      else np.datetime64(request.args[x], 'D')
+                      for x in ['start', 'end']]
+    except ValueError:
+        abort(400)
+    resolution = request.args.get('resolution', 'daily')
+    if resolution not in downsample.RESOLUTIONS:
+        abort(400)
+    max_points = request.args.get('max_points', type=int)
+    if max_points is not None:
+        max_points = max(max_points, 3)
+    return {'start': start, 'end': end, 'resolution': resolution,
+            'max_points': max_points}
+
+
+def date_strings(dates):
+    return np.datetime_as_string(dates, unit='D').tolist()
+
+
+def json_values(values):
+    # NaN, which is how sqlite's NULLs come back in float columns, isn't
+    # valid JSON.
+    if values.dtype.kind != 'f':
+        return values.tolist()
+    return [None if x != x else x for x in values.tolist()]
+
+
+def get_encoding():
+    # Best encoding the client accepts, or None to send the body as is.
+    if brotli is not None and 'br' in request.accept_encodings:
+        return 'br'
+    if 'gzip' in request.accept_encodings:
+        return 'gzip'
+    return None
+
+
+def encode_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def cached_response(view, kwargs, serialize, mimetype):
+    # Serves repeat requests for the same page from the page cache, already
+    # compressed, and answers conditional requests with a 304, until the
+    # data is refreshed.
+    version = get_data_version()
+    encoding = get_encoding()
+    etag = hashlib.sha1((request.full_path + '|' + str(version) + '|' +
+                         str(encoding)).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    key = (request.endpoint, tuple(sorted(kwargs.items())),
+           tuple(sorted(request.args.items())), version, encoding)
+    cached = pages.get(key)
+    if cached is None:
+        result = view(**kwargs)
+        if not isinstance(result, (str, dict)):  # Redirects aren't cached.
+            return result
+        with metrics.phase('render'):
+            body = serialize(result).encode()
+            if len(body) < COMPRESS_MIN_BYTES:
+                cached = (None, body)
+            else:
+                cached = (encoding, encode_body(body, encoding))
+        pages.put(key, cached, len(cached[1]))
+
+    response = make_response(cached[1])
+    response.mimetype = mimetype
+    if cached[0] is not None:
+        response.headers['Content-Encoding'] = cached[0]
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = API_MAX_AGE
+    response.set_etag(etag)
+    return response
+
+
+def cached_page(view):
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        return cached_response(view, kwargs, str, 'text/html')
+    return wrapper
+
+
+def cached_api(view):
+    # Like cached_page, for views returning a dict to send as JSON.
+    @functools.wraps(view)
+    def wrapper(**kwargs):
+        return cached_response(view, kwargs, compact_json, 'application/json')
+    return wrapper
+
+
+def compact_json(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+@views.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(pages.stats())
+
+
+@views.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    for name, value in pages.stats().items():
+        metrics.registry.set('covid_page_cache_' + name, value)
+    response = make_response(metrics.render())
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
+def begin_request():
+    metrics.begin_request()
+    if metrics.PROFILE_REQUESTS and 'profile' in request.args:
+        try:
+            g.profiler = metrics.start_profiler(request.args['profile'])
+        except ValueError:  # Another request is being profiled.
+            pass
+
+
+def end_request(response):
+    if 'profiler' in g:
+        report, mimetype = metrics.stop_profiler(g.pop('profiler'))
+        response = make_response(report)
+        response.mimetype = mimetype
+    metrics.end_request(request.endpoint, response.status_code)
+    return response
+
+
+def template_started(sender, **extra):
+    metrics.start_phase('render')
+
+
+def template_finished(sender, **extra):
+    metrics.stop_phase('render')
+
+
+@views.route('/')
+@views.route('/index')
+@views.route('/index.html')
+def index():
+    return render_template('index.html')
 
 
 # US SECTION
-@app.route('/us', methods=['GET'])
-@app.route('/us.html', methods=['GET'])
+@views.route('/us', methods=['GET'])
+@views.route('/us.html', methods=['GET'])
 def us():
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    query = 'SELECT DISTINCT date FROM us ORDER BY date;'
-    dates = cur.execute(query).fetchall()
-    conn.close()
-    return render_template('us.html', dates=[x['date'] for x in dates])
+    return render_template('us.html', dates=get_catalog()['dates']['us'])
 
 
-@app.route('/us/date_results', methods=['POST'])
+@views.route('/us/date_results', methods=['POST'])
 def us_date_results():
     return redirect('/us/us_date_'+request.form['date'])
 
 
-@app.route('/us/us_date_<date>', methods=['GET'])
+@views.route('/us/us_date_<date>', methods=['GET'])
+@cached_page
 def us_date(date):
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    cur = get_db().cursor()
 
-    query = 'SELECT * FROM us INNER JOIN us_census WHERE date=?;'
-    date_data = cur.execute(query, tuple([date])).fetchall()
-    conn.close()
+    query = date_query('us')
+    date_data = cur.execute(query, tuple(['', date])).fetchall()
 
     return render_template('us_date.html',
                            order=TABLE_ORDER,
@@ -64,347 +393,443 @@ def us_date(date):
                            date_data=date_data)
 
 
-@app.route('/us/graph_results', methods=['POST'])
+@views.route('/us/graph_results', methods=['POST'])
 def us_graph_results():
     return redirect('/us/us_graph_'+request.form['graph'])
 
 
-@app.route('/us/us_graph_<graph>', methods=['GET'])
+@views.route('/us/us_graph_<graph>', methods=['GET'])
+@cached_page
 def us_graph(graph):
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    fig = go.Figure()
-    if graph == 'both':
-        query = 'SELECT date,cases,deaths FROM us;'
-        graph_data = cur.execute(query).fetchall()
-        x_data = [x['date'] for x in graph_data]
-        y1_data = [x['cases'] for x in graph_data]
-        y2_data = [x['deaths'] for x in graph_data]
-        fig.add_trace(go.Scatter(x=x_data, y=y1_data, name='Cases'))
-        fig.add_trace(go.Scatter(x=x_data, y=y2_data, name='Deaths'))
-        fig.update_layout(yaxis_title='Number of Cases/Deaths')
-    elif graph == 'cases':
-        query = 'SELECT date,cases FROM us;'
-        graph_data = cur.execute(query).fetchall()
-        x_data = [x['date'] for x in graph_data]
-        y_data = [x['cases'] for x in graph_data]
-        fig.add_trace(go.Scatter(x=x_data, y=y_data, name='Cases'))
-        fig.update_layout(yaxis_title='Number of Cases')
-    elif graph == 'deaths':
-        query = 'SELECT date,deaths FROM us;'
-        graph_data = cur.execute(query).fetchall()
-        x_data = [x['date'] for x in graph_data]
-        y_data = [x['deaths'] for x in graph_data]
-        fig.add_trace(go.Scatter(x=x_data, y=y_data, name='Deaths'))
-        fig.update_layout(yaxis_title='Number of Deaths')
-    else:
-        return render_template('us_graph.html',
-                               graph_div='')
-    conn.close()
-
-    fig.update_layout(xaxis_title='Date')
+    if graph not in US_GRAPH_TITLES:
+        return render_template('us_graph.html', chart=None)
 
-    return render_template('us_graph.html',
-                           graph_div=fig.to_html(full_html=False))
+    columns = ['cases', 'deaths'] if graph == 'both' else [graph]
+    chart = dict(src=url_for('.api_series', level='us',
+                             columns=','.join(columns),
+                             max_points=CHART_MAX_POINTS),
+                 columns=columns, ytitle=US_GRAPH_TITLES[graph])
+    return render_template('us_graph.html', chart=chart)
 
 
 # STATE SECTION
-@app.route('/state', methods=['GET'])
-@app.route('/state.html', methods=['GET'])
+@views.route('/state', methods=['GET'])
+@views.route('/state.html', methods=['GET'])
 def state():
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    query = 'SELECT DISTINCT fips FROM state ORDER BY fips;'
-    states = cur.execute(query).fetchall()
-
-    query = 'SELECT DISTINCT date FROM state ORDER BY date;'
-    dates = cur.execute(query).fetchall()
-    conn.close()
-
     return render_template('state.html',
-                           states=[x['fips'] for x in states],
-                           state_dict=state_dict,
-                           dates=[x['date'] for x in dates])
+                           compare_counts=COMPARE_COUNTS,
+                           dates=get_catalog()['dates']['state'])
 
 
-@app.route('/state/date_results', methods=['POST'])
+@views.route('/state/date_results', methods=['POST'])
 def state_date_results():
-    return redirect('/state/state_date/' + request.form['state']
+    return redirect('/state/state_date/' + get_place('state', 'state')
                     + '/' + request.form['date'])
 
 
-@app.route('/state/state_date/<state>/<date>', methods=['GET'])
+@views.route('/state/state_date/<state>/<date>', methods=['GET'])
+@cached_page
 def state_date(state, date):
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    query = ('SELECT * FROM state INNER JOIN state_census'
-             + ' as Cen ON fips=Cen.state WHERE fips=? ORDER BY date;')
-    query_data = cur.execute(query, tuple([state])).fetchall()
-    dates = [x['date'] for x in query_data]
-    if date not in dates:
-        if date < dates[0]:
-            return redirect('/state/state_date/' + state
-                            + '/' + dates[0])
-        else:
-            return redirect('/state/state_date/' + state
-                            + '/' + dates[-1])
-    conn.close()
-
-    fig = go.Figure()
-    y1_data = [x['cases'] for x in query_data]
-    y2_data = [x['deaths'] for x in query_data]
-    fig.add_trace(go.Scatter(x=dates, y=y1_data, name='Cases'))
-    fig.add_trace(go.Scatter(x=dates, y=y2_data, name='Deaths'))
-    fig.update_layout(xaxis_title='Date')
-    fig.update_layout(yaxis_title='Number of Cases/Deaths')
-    fig.update_layout(annotations=[
-        dict(x=date, y=0, xref='x', yref='y', text='Selected Date',
-             showarrow=True, arrowhead=7, ax=0, ay=-10)
-    ])
-
-    date_data = None
-    for row in query_data:
-        if row['date'] == date:
-            date_data = row
-
+    state_name = place_name('state_names', state)
+    cur = get_db().cursor()
+
+    query = date_query('state')
+    date_data = cur.execute(query, tuple([state, date])).fetchone()
+    if date_data is None:
+        dates = get_series('state', state)['date']
+        if len(dates) == 0:
+            abort(404)
+        closest = str(dates[0]) if date < str(dates[0]) else str(dates[-1])
+        if closest == date:
+            abort(404)
+        return redirect('/state/state_date/' + state + '/' + closest)
+    county_totals = cur.execute(county_totals_query(),
+                                tuple([state, date])).fetchone()
+
+    chart = dict(src=url_for('.api_series', level='state', fips=state,
+                             max_points=CHART_MAX_POINTS),
+                 columns=['cases', 'deaths'], ytitle=US_GRAPH_TITLES['both'],
+                 date=date)
     return render_template('state_detail.html',
-                           graph_div=fig.to_html(full_html=False),
+                           chart=chart,
                            order=TABLE_ORDER,
                            names=TABLE_NAMES,
-                           state=state_dict[state],
-                           date_data=date_data)
+                           state=state_name,
+                           date_data=date_data,
+                           county_totals=county_totals,
+                           county_names=COUNTY_TOTALS_NAMES)
 
 
-@app.route('/state/graph_results', methods=['POST'])
+@views.route('/state/graph_results', methods=['POST'])
 def state_graph_results():
     compare = request.form['comparison'].replace(' ', '_')
     return redirect('/state/state_compare/' + compare
-                    + '/' + request.form['yaxis'])
+                    + '/' + request.form['yaxis']
+                    + '?count=' + request.form.get('count', '5'))
 
 
-@app.route('/state/state_compare/<comparison>/<yaxis>', methods=['GET'])
+@views.route('/state/state_compare/<comparison>/<yaxis>', methods=['GET'])
+@cached_page
 def state_graph(comparison, yaxis):
-    compare = comparison.replace('_', ' ')
-    compare_var = compare.split(' ')[0]
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    fig = go.Figure()
-    query = ''
-    states = list()
-    if compare_var in ['cases', 'deaths']:
-        query = 'SELECT DISTINCT date FROM state ORDER BY date desc LIMIT 1;'
-        date = cur.execute(query).fetchall()[0]['date']
-        query = ('SELECT fips,' + compare_var + " FROM state WHERE date='"
-                 + date + "' and fips in ('" + "','".join(state_dict.keys())
-                 + "') ORDER BY " + compare + ' LIMIT 5;')
-        states = [x['fips'] for x in cur.execute(query).fetchall()]
-    else:
-        query = ('SELECT state,' + compare_var + ' FROM state_census ORDER BY '
-                 + compare + ' LIMIT 5;')
-        states = [x['state'] for x in cur.execute(query).fetchall()]
-
-    for state in states:
-        query = 'SELECT date,' + yaxis + ' FROM state WHERE fips=?;'
-        results = cur.execute(query, tuple([state])).fetchall()
-        x_data = [x['date'] for x in results]
-        y_data = [x[yaxis] for x in results]
-        fig.add_trace(go.Scatter(x=x_data, y=y_data,
-                                 name=state_dict[state]))
-
-    conn.close()
-
-    fig.update_layout(xaxis_title='Date',
-                      yaxis_title=yaxis[0].upper() + yaxis[1:])
-
-    metric = None
-    if compare_var == 'pop':
-        metric = 'Population'
-    else:
-        metric = compare_var[0].upper() + compare_var[1:]
-
-    if compare.split(' ')[1] == 'asc':
-        metric = ' by States with Lowest ' + metric
-    else:
-        metric = ' by States with Highest ' + metric
-
-    metric = yaxis[0].upper() + yaxis[1:] + metric
-
+    parsed = parse_comparison(comparison, yaxis)
+    if parsed is None:
+        return render_template('state_graph.html', metric='', chart=None)
+
+    chart = dict(src=url_for('.api_compare', comparison=comparison,
+                             yaxis=yaxis, count=get_compare_count(),
+                             max_points=CHART_MAX_POINTS),
+                 ytitle=yaxis[0].upper() + yaxis[1:])
     return render_template('state_graph.html',
-                           metric=metric,
-                           graph_div=fig.to_html(full_html=False))
+                           metric=compare_metric(*parsed, yaxis, 'States'),
+                           chart=chart)
 
 
 # COUNTY SECTION
-@app.route('/county/state_selector', methods=['POST'])
+@views.route('/county/state_selector', methods=['POST'])
 def county_state_results():
-    return redirect('/county/' + request.form['state'])
+    return redirect('/county/' + get_place('state', 'state'))
 
 
-@app.route('/county/<state>', methods=['GET'])
-@app.route('/county/<state>.html', methods=['GET'])
+@views.route('/county/<state>', methods=['GET'])
+@views.route('/county/<state>.html', methods=['GET'])
 def county(state):
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    query = ("SELECT DISTINCT fips FROM county WHERE substr(fips,1,2)='"
-             + state + "' ORDER BY fips;")
-    counties = cur.execute(query).fetchall()
-
-    query = 'SELECT DISTINCT date FROM county ORDER BY date;'
-    dates = cur.execute(query).fetchall()
-    conn.close()
-
+    places = get_catalog()
     return render_template('county.html',
-                           counties=[x['fips'] for x in counties],
-                           county_dict=county_dict,
                            state=state,
-                           state_dict=state_dict,
-                           dates=[x['date'] for x in dates])
+                           state_dict=places['state_names'],
+                           compare_counts=COMPARE_COUNTS,
+                           dates=places['dates']['county'])
 
 
-@app.route('/county/date_results/<state>', methods=['POST'])
+@views.route('/county/date_results/<state>', methods=['POST'])
 def county_date_results(state):
     return redirect('/county/county_details/' + state + '/' +
-                    request.form['county'] + '/' + request.form['date'])
+                    get_place('county', 'county', state) + '/' +
+                    request.form['date'])
 
 
-@app.route('/county/county_details/<state>/<county>/<date>', methods=['GET'])
+@views.route('/county/county_details/<state>/<county>/<date>', methods=['GET'])
+@cached_page
 def county_date(state, county, date):
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    query = ('SELECT * FROM county INNER JOIN county_census'
-             + ' as Cen ON fips=Cen.state||Cen.county WHERE'
-             + ' fips=? ORDER BY date;')
-    query_data = cur.execute(query, tuple([county])).fetchall()
-    dates = [x['date'] for x in query_data]
-    if date not in dates:
-        if date < dates[0]:
-            return redirect('/county/county_details/' + state + '/'
-                            + county + '/' + dates[0])
-        else:
-            return redirect('/county/county_details/' + state + '/'
-                            + county + '/' + dates[-1])
-    conn.close()
-
-    fig = go.Figure()
-    y1_data = [x['cases'] for x in query_data]
-    y2_data = [x['deaths'] for x in query_data]
-    fig.add_trace(go.Scatter(x=dates, y=y1_data, name='Cases'))
-    fig.add_trace(go.Scatter(x=dates, y=y2_data, name='Deaths'))
-    fig.update_layout(xaxis_title='Date')
-    fig.update_layout(yaxis_title='Number of Cases/Deaths')
-    fig.update_layout(annotations=[
-        dict(x=date, y=0, xref='x', yref='y', text='Selected Date',
-             showarrow=True, arrowhead=7, ax=0, ay=-10)
-    ])
-
-    date_data = None
-    for row in query_data:
-        if row['date'] == date:
-            date_data = row
-
+    state_name = place_name('state_names', state)
+    county_name = place_name('county_names', county)
+    cur = get_db().cursor()
+
+    query = date_query('county')
+    date_data = cur.execute(query, tuple([county, date])).fetchone()
+    if date_data is None:
+        dates = get_series('county', county)['date']
+        if len(dates) == 0:
+            abort(404)
+        closest = str(dates[0]) if date < str(dates[0]) else str(dates[-1])
+        if closest == date:
+            abort(404)
+        return redirect('/county/county_details/' + state + '/'
+                        + county + '/' + closest)
+
+    chart = dict(src=url_for('.api_series', level='county', fips=county,
+                             max_points=CHART_MAX_POINTS),
+                 columns=['cases', 'deaths'], ytitle=US_GRAPH_TITLES['both'],
+                 date=date)
     return render_template('county_detail.html',
-                           graph_div=fig.to_html(full_html=False),
+                           chart=chart,
                            order=TABLE_ORDER,
                            names=TABLE_NAMES,
-                           state=state_dict[state],
-                           county=county_dict[county],
+                           state=state_name,
+                           county=county_name,
                            date_data=date_data)
 
 
-@app.route('/county/county_compare/<state>', methods=['POST'])
+@views.route('/county/county_compare/<state>', methods=['POST'])
 def county_graph_results(state):
     compare = request.form['comparison'].replace(' ', '_')
     return redirect('/county/county_compare/' + state + '/' + compare
-                    + '/' + request.form['yaxis'])
+                    + '/' + request.form['yaxis']
+                    + '?count=' + request.form.get('count', '5'))
 
 
-@app.route('/county/county_compare/<state>/<comparison>/<yaxis>', methods=['GET'])
+@views.route('/county/county_compare/<state>/<comparison>/<yaxis>', methods=['GET'])
+@cached_page
 def county_graph(state, comparison, yaxis):
-    compare = comparison.replace('_', ' ')
-    compare_var = compare.split(' ')[0]
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    fig = go.Figure()
-    query = ''
-    counties = list()
-    if compare_var in ['cases', 'deaths']:
-        query = 'SELECT DISTINCT date FROM county ORDER BY date desc LIMIT 1;'
-        date = cur.execute(query).fetchall()[0]['date']
-        query = ('SELECT fips,' + compare_var + " FROM county WHERE date='"
-                 + date + "' and fips in (SELECT state||county FROM "
-                 + "county_census WHERE state='" + state + "') ORDER BY "
-                 + compare + ' LIMIT 5;')
-        counties = [x['fips'] for x in cur.execute(query).fetchall()]
-    else:
-        query = ('SELECT state||county as county_fips,' + compare_var +
-                 " FROM county_census WHERE state='" + state + "' ORDER BY "
-                 + compare + ' LIMIT 5;')
-        counties = [x['county_fips'] for x in cur.execute(query).fetchall()]
-
-    for county in counties:
-        query = 'SELECT date,' + yaxis + ' FROM county WHERE fips=?;'
-        results = cur.execute(query, tuple([county])).fetchall()
-        x_data = [x['date'] for x in results]
-        y_data = [x[yaxis] for x in results]
-        fig.add_trace(go.Scatter(x=x_data, y=y_data,
-                                 name=county_dict[county]))
-
-    conn.close()
-
-    fig.update_layout(xaxis_title='Date',
-                      yaxis_title=yaxis[0].upper() + yaxis[1:])
-
-    metric = None
-    if compare_var == 'pop':
-        metric = 'Population'
+    state_name = place_name('state_names', state)
+    parsed = parse_comparison(comparison, yaxis)
+    if parsed is None:
+        return render_template('county_graph.html',
+                               state=state_name,
+                               metric='', chart=None)
+
+    chart = dict(src=url_for('.api_compare', state=state,
+                             comparison=comparison, yaxis=yaxis,
+                             count=get_compare_count(),
+                             max_points=CHART_MAX_POINTS),
+                 ytitle=yaxis[0].upper() + yaxis[1:])
+    return render_template('county_graph.html',
+                           state=state_name,
+                           metric=compare_metric(*parsed, yaxis, 'Counties'),
+                           chart=chart)
+
+
+# API SECTION
+# Compact columnar JSON that the graph pages fetch and draw in the browser.
+# Series can be limited with start and end dates, aggregated with
+# resolution=weekly or monthly, and thinned to max_points per line.
+@views.route('/api/v1/series/<level>', methods=['GET'],
+             defaults={'fips': ''})
+@views.route('/api/v1/series/<level>/<fips>', methods=['GET'])
+@cached_api
+def api_series(level, fips):
+    if (level not in series_store.SERIES_LEVELS
+            or (level == 'us') != (fips == '')):
+        abort(404)
+    columns = request.args.get('columns', 'cases,deaths').split(',')
+    if not set(columns) <= set(SERIES_API_COLUMNS):
+        abort(400)
+    data = get_series(level, fips)
+    if len(data['date']) == 0:
+        abort(404)
+    data = downsample.downsample(data, key=columns[0], **get_window())
+
+    if level == 'us':
+        name = 'United States'
     else:
-        metric = compare_var[0].upper() + compare_var[1:]
-
-    if compare.split(' ')[1] == 'asc':
-        metric = ' by Counties with Lowest ' + metric
+        name = get_catalog()[level + '_names'].get(fips, fips)
+    result = {'level': level, 'fips': fips, 'name': name,
+              'dates': date_strings(data['date'])}
+    for column in columns:
+        result[column] = data[column].tolist()
+    return result
+
+
+@views.route('/api/v1/compare/state/<comparison>/<yaxis>', methods=['GET'],
+             defaults={'state': None})
+@views.route('/api/v1/compare/county/<state>/<comparison>/<yaxis>',
+             methods=['GET'])
+@cached_api
+def api_compare(state, comparison, yaxis):
+    parsed = parse_comparison(comparison, yaxis)
+    if parsed is None:
+        abort(404)
+
+    if state is None:
+        fips_list = rank_fips(*parsed, get_compare_count())
+        all_series = get_series_batch('state', fips_list)
+        names = get_catalog()['state_names']
+        metric = compare_metric(*parsed, yaxis, 'States')
     else:
-        metric = ' by Counties with Highest ' + metric
-
-    metric = yaxis[0].upper() + yaxis[1:] + metric
-
-    return render_template('county_graph.html',
-                           state=state_dict[state],
-                           metric=metric,
-                           graph_div=fig.to_html(full_html=False))
+        fips_list = rank_fips(*parsed, get_compare_count(), state)
+        all_series = get_series_batch('county', fips_list)
+        names = get_catalog()['county_names']
+        metric = compare_metric(*parsed, yaxis, 'Counties')
+
+    window = get_window()
+    result = {'metric': metric, 'yaxis': yaxis, 'series': []}
+    for fips in fips_list:
+        data = downsample.downsample(all_series[fips], key=yaxis, **window)
+        result['series'].append({'fips': fips, 'name': names.get(fips, fips),
+                                 'dates': date_strings(data['date']),
+                                 'values': data[yaxis].tolist()})
+    return result
+
+
+@views.route('/api/v1/cross_section/<level>/<date>', methods=['GET'])
+@cached_api
+def api_cross_section(level, date):
+    # Every state or county on one date, for the maps.
+    if level not in cross_section.CROSS_SECTION_LEVELS:
+        abort(404)
+    columns = request.args.get('columns', 'cases,deaths').split(',')
+    if not set(columns) <= set(cross_section.CROSS_SECTION_COLUMNS):
+        abort(400)
+    data = cross_section.get_cross_section(series, get_db().cursor(), level,
+                                           date, get_data_version())
+    if data is None:
+        abort(404)
+
+    names = get_catalog()[level + '_names']
+    result = {'level': level, 'date': date, 'fips': data['fips'].tolist()}
+    result['names'] = [names.get(x, x) for x in result['fips']]
+    for column in columns:
+        result[column] = json_values(data[column])
+    return result
+
+
+# Ranked state and county names starting with q, or with a word of it, for
+# the autocomplete fields; see search. level and state narrow the matches.
+@views.route('/api/v1/search', methods=['GET'])
+def api_search():
+    level = request.args.get('level')
+    state = request.args.get('state')
+    if ((level is not None and level not in search.SEARCH_LEVELS)
+            or (state is not None and (len(state) != 2
+                                       or not state.isdigit()))):
+        abort(400)
+    limit = request.args.get('limit', search.SEARCH_LIMIT, type=int)
+    limit = min(max(limit, 1), search.SEARCH_MAX_LIMIT)
+    query = request.args.get('q', '')
+    response = jsonify({'query': query,
+                        'results': get_place_index().search(query, limit,
+                                                            level, state)})
+    response.cache_control.public = True
+    response.cache_control.max_age = API_MAX_AGE
+    return response
+
+
+# Everything for a level, optionally one state's and between start and end
+# dates, streamed as it is read so a full county export stays small.
+@views.route('/api/v1/export/<level>.<fmt>', methods=['GET'])
+def api_export(level, fmt):
+    if level not in export.EXPORT_LEVELS or fmt not in export.formats():
+        abort(404)
+    state = request.args.get('state')
+    if state is not None and (level == 'us' or len(state) != 2
+                              or not state.isdigit()):
+        abort(400)
+    window = get_window()
+    start, end = [None if window[x] is None else str(window[x])
+                  for x in ['start', 'end']]
+
+    # Its own connection, held until the response is closed rather than
+    # returned to the pool when the request's context ends.
+    conn = pool.acquire()
+    response = Response(export.stream_export(conn.cursor(), level, fmt,
+                                             state, start, end),
+                        mimetype=export.EXPORT_FORMATS[fmt])
+    response.call_on_close(lambda: pool.release(conn))
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=covid_' + level + '.' + fmt)
+    return response
+
+
+# MAP SECTION
+@views.route('/map', methods=['GET'])
+def map_select():
+    return render_template('map_select.html', names=MAP_NAMES,
+                           dates=get_catalog()['dates']['county'])
+
+
+@views.route('/map/results', methods=['POST'])
+def map_results():
+    return redirect('/map/' + request.form['level'] + '/'
+                    + request.form['date'] + '/' + request.form['metric'])
+
+
+@views.route('/map/<level>/<date>/<metric>', methods=['GET'])
+@cached_page
+def choropleth(level, date, metric):
+    if level not in geo.GEO_LEVELS or metric not in MAP_NAMES:
+        abort(404)
+    places = 'States' if level == 'state' else 'Counties'
+    chart = dict(src=url_for('.api_cross_section', level=level, date=date,
+                             columns=metric),
+                 geo=url_for('.geo_shapes', level=level), metric=metric,
+                 title=MAP_NAMES[metric] + ' by ' + places + ' on ' + date)
+    return render_template('map.html', chart=chart)
+
+
+@views.route('/geo/<level>.json', methods=['GET'])
+def geo_shapes(level):
+    # The simplified shapes data_setup writes, compressed once per encoding
+    # and reloaded when the file changes.
+    if level not in geo.GEO_LEVELS:
+        abort(404)
+    try:
+        mtime = os.stat(geo.asset_path(level)).st_mtime_ns
+    except OSError:
+        abort(404)
+    encoding = get_encoding()
+    cached = geo_assets.get((level, encoding))
+    if cached is None or cached[0] != mtime:
+        with open(geo.asset_path(level), 'rb') as asset:
+            cached = (mtime, encode_body(asset.read(), encoding))
+        geo_assets[(level, encoding)] = cached
+
+    response = make_response(cached[1])
+    response.mimetype = 'application/geo+json'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = GEO_MAX_AGE
+    response.set_etag(str(mtime) + '-' + str(encoding))
+    return response.make_conditional(request)
+
+
+@views.route('/plotly-<version>.min.js', methods=['GET'])
+def plotly_bundle(version):
+    # The plotly.js shipped with the installed plotly package, compressed
+    # once per encoding. The URL changes with the version, so browsers can
+    # keep it for a year.
+    if version != plotly.__version__:
+        abort(404)
+    encoding = get_encoding()
+    if encoding not in plotly_bundles:
+        with open(os.path.join(os.path.dirname(plotly.__file__),
+                               'package_data', 'plotly.min.js'),
+                  'rb') as bundle:
+            plotly_bundles[encoding] = encode_body(bundle.read(), encoding)
+
+    response = make_response(plotly_bundles[encoding])
+    response.mimetype = 'text/javascript'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    response.set_etag(version + '-' + str(encoding))
+    return response.make_conditional(request)
+
+
+def get_plotly_version():
+    return plotly.__version__
+
+
+@views.app_context_processor
+def plotly_version():
+    # A function, so only the pages with charts import plotly.
+    return {'plotly_version': get_plotly_version}
+
+
+def create_app():
+    app = Flask(__name__)
+    app.register_blueprint(views)
+    app.teardown_appcontext(release_db)
+    if metrics.ENABLED or metrics.PROFILE_REQUESTS:
+        app.before_request(begin_request)
+        app.after_request(end_request)
+    if metrics.ENABLED:
+        before_render_template.connect(template_started, app)
+        template_rendered.connect(template_finished, app)
+    return app
+
+
+def preload(app):
+    # For servers that fork workers from an app loaded in the parent
+    # (gunicorn --preload): load the catalog, name index and series maps
+    # once there, then move everything allocated so far out of the garbage
+    # collector's reach, so collections in the workers don't write to, and
+    # so copy, the pages they share with the parent.
+    with app.app_context():
+        version = get_data_version()
+        get_place_index()
+        for level in series_store.SERIES_LEVELS:
+            series.load_level(level, version)
+    lazy.load(np, plotly)
+    gc.freeze()
+
+
+app = create_app()
 
 
 if __name__ == "__main__":
-    data_setup.main_data_setup()
-
-    conn = sqlite3.connect(data_setup.PROJECT_DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    state_dict = dict()
-    query = 'SELECT state, name FROM state_census;'
-    for row in cur.execute(query).fetchall():
-        state_dict[row['state']] = row['name']
-
-    county_dict = dict()
-    query = ("select [state]||[county] as fips, " +
-             "substr([name],0,instr([name],',')) " +
-             "as name from county_census;")
-    for row in cur.execute(query).fetchall():
-        county_dict[row['fips']] = row['name']
-
-    conn.close()
-    app.run(debug=True)
+    if SNAPSHOT:
+        app.run()  # Nothing to refresh, and no reloader to import it twice.
+    else:
+        if not os.path.exists(data_setup.PROJECT_DATABASE_NAME):
+            # Nothing to serve until the first run.
+            data_setup.main_data_setup()
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            # Only in the reloader's child, which serves the pages.
+            refresh_scheduler.RefreshScheduler().start()
+
+        app.run(debug=True)
@@ -0,0 +1,80 @@
+import json
+import os
+
+
+GEO_DIR = 'geo_cache'
+GEO_LEVELS = ['state', 'county']
+GEO_PRECISION = 2  # Decimal places kept in coordinates, about 1 km.
+
+
+# Map shapes for the choropleths, made at ingest from a county GeoJSON
+# whose features have 5 digit fips ids. Coordinates are rounded to
+# GEO_PRECISION and points that then repeat are dropped, which shrinks
+# the file several times over without a visible change at national scale.
+# A state is drawn as the MultiPolygon of all its counties.
+
+def asset_path(level, directory=GEO_DIR):
+    return os.path.join(directory, level + '.json')
+
+
+def assets_exist(directory=GEO_DIR):
+    return all(os.path.exists(asset_path(x, directory)) for x in GEO_LEVELS)
+
+
+def simplify_ring(ring):
+    points = list()
+    for point in ring:
+        point = [round(point[0], GEO_PRECISION), round(point[1], GEO_PRECISION)]
+        if not points or point != points[-1]:
+            points.append(point)
+    if len(points) < 4:
+        return None  # Collapsed to a line or a point.
+    return points
+
+
+def simplify_polygons(geometry):
+    # The geometry's polygons as a MultiPolygon's coordinates, without the
+    # rings that collapse.
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    else:
+        polygons = geometry['coordinates']
+    simplified = list()
+    for polygon in polygons:
+        rings = [simplify_ring(x) for x in polygon]
+        if rings[0] is not None:
+            simplified.append([x for x in rings if x is not None])
+    return simplified
+
+
+def feature(fips, polygons):
+    return {'type': 'Feature', 'id': fips,
+            'geometry': {'type': 'MultiPolygon', 'coordinates': polygons}}
+
+
+def write_asset(level, features, directory):
+    path = asset_path(level, directory)
+    with open(path + '.tmp', 'w') as asset:
+        json.dump({'type': 'FeatureCollection', 'features': features}, asset,
+                  separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def build_geo_assets(source_path, directory=GEO_DIR):
+    with open(source_path, encoding='utf-8') as source:
+        features = json.load(source)['features']
+    counties = list()
+    states = dict()
+    for county in features:
+        fips = str(county.get('id', ''))
+        if len(fips) != 5 or not county.get('geometry'):
+            continue
+        polygons = simplify_polygons(county['geometry'])
+        if polygons:
+            counties.append(feature(fips, polygons))
+            states.setdefault(fips[:2], []).extend(polygons)
+
+    os.makedirs(directory, exist_ok=True)
+    write_asset('county', counties, directory)
+    write_asset('state', [feature(x, y) for x, y in sorted(states.items())],
+                directory)
@@ -0,0 +1,24 @@
+# Read by gunicorn from the directory it is started in. Starts the one
+# background data refresh for the whole server from the master process,
+# as its own command (see refresh_scheduler), and stops it with the
+# server. Workers only read what it publishes.
+import os
+import subprocess
+import sys
+
+
+REFRESHER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'refresh_scheduler.py')
+refresher = None
+
+
+def when_ready(server):
+    global refresher
+    if os.environ.get('SNAPSHOT') != '1':  # Snapshots are never refreshed.
+        refresher = subprocess.Popen([sys.executable, REFRESHER])
+
+
+def on_exit(server):
+    if refresher is not None:
+        refresher.terminate()
+        refresher.wait(10)
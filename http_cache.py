@@ -0,0 +1,174 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+import time
+import urllib.parse
+
+
+HTTP_CACHE_DIR = 'http_cache'
+HTTP_CACHE_MAX_BYTES = 2 * 1024 ** 3
+SECRET_PARAMS = {'key'}  # Only in cache keys as a digest; never stored.
+HASH_CHUNK_SIZE = 1024 * 1024
+# Longer than a download can take to go from objects/ into the index.
+ORPHAN_SECONDS = 3600
+
+
+# Response bodies are stored once per distinct content, as
+# objects/<sha256>, and an sqlite index maps each request to its body and
+# HTTP validators. Every fetch opens its own index connection, so several
+# download threads (or processes) can share the cache.
+
+class CacheMiss(LookupError):
+    pass
+
+
+def request_key(url, params=None):
+    # The request URL with every parameter, in a stable order, and secrets
+    # replaced by their digest, so that requests made with different keys
+    # don't share an entry.
+    params = sorted((x, secret_digest(y) if x in SECRET_PARAMS else y)
+                    for x, y in (params or dict()).items())
+    if not params:
+        return url
+    return url + '?' + urllib.parse.urlencode(params)
+
+
+def secret_digest(value):
+    return 'sha256:' + hashlib.sha256(str(value).encode()).hexdigest()[:16]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as body:
+        for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HttpCache:
+
+    def __init__(self, directory=HTTP_CACHE_DIR,
+                 max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'tmp'), exist_ok=True)
+
+    def connect(self):
+        conn = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'),
+                               timeout=60)
+        conn.row_factory = sqlite3.Row
+        conn.execute("CREATE TABLE IF NOT EXISTS entries " +
+                     "(key TEXT PRIMARY KEY, digest TEXT NOT NULL, " +
+                     "size INTEGER NOT NULL, etag TEXT, last_modified TEXT, " +
+                     "fetched_at REAL NOT NULL, used_at REAL NOT NULL);")
+        return conn
+
+    def entry(self, row):
+        entry = dict(row)
+        entry['path'] = os.path.join(self.directory, 'objects', row['digest'])
+        return entry
+
+    def fetch(self, url, params, ttl, download, offline=False):
+        # Returns the cache entry for a GET of url, a dict including the
+        # body's 'path' and 'digest'. Entries younger than ttl seconds are
+        # used as they are, older ones are revalidated. When the network
+        # fails, or offline is set, any stored entry is used regardless of
+        # age. download(url, params, headers, directory) must return
+        # (response, body path), with a None path for a 304.
+        key = request_key(url, params)
+        now = time.time()
+        with contextlib.closing(self.connect()) as conn:
+            cmd = "SELECT * FROM entries WHERE key=?;"
+            row = conn.execute(cmd, (key,)).fetchone()
+            if row is not None and os.path.exists(self.entry(row)['path']):
+                if offline or now - row['fetched_at'] < ttl:
+                    with conn:
+                        cmd = "UPDATE entries SET used_at=? WHERE key=?;"
+                        conn.execute(cmd, (now, key))
+                    return self.entry(row)
+            else:
+                row = None
+            if offline:
+                raise CacheMiss('Not cached: ' + key)
+
+            headers = dict()
+            if row is not None and row['etag']:
+                headers['If-None-Match'] = row['etag']
+            if row is not None and row['last_modified']:
+                headers['If-Modified-Since'] = row['last_modified']
+            try:
+                response, path = download(url, params, headers,
+                                          os.path.join(self.directory, 'tmp'))
+            except OSError as exception:
+                if row is None:
+                    raise
+                print('Using cached ' + key + ' after: ' + str(exception))
+                return self.entry(row)
+
+            if path is None:  # 304, the stored body is still current.
+                with conn:
+                    cmd = ("UPDATE entries SET fetched_at=?, used_at=? " +
+                           "WHERE key=?;")
+                    conn.execute(cmd, (now, now, key))
+                return self.entry(row)
+
+            digest = file_digest(path)
+            stored = os.path.join(self.directory, 'objects', digest)
+            if os.path.exists(stored):
+                os.remove(path)
+                os.utime(stored)  # Not an orphan to evict.
+            else:
+                os.replace(path, stored)
+            with conn:
+                cmd = "SELECT digest FROM entries WHERE key=?;"
+                replaced = conn.execute(cmd, (key,)).fetchone()
+                cmd = "INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?);"
+                conn.execute(cmd, (key, digest, os.path.getsize(stored),
+                                   response.headers.get('ETag'),
+                                   response.headers.get('Last-Modified'),
+                                   now, now))
+            if replaced is not None and replaced[0] != digest:
+                self.remove_unused(conn, replaced[0])
+            self.evict(conn, keep=key)
+            return self.entry(conn.execute("SELECT * FROM entries WHERE key=?;",
+                                           (key,)).fetchone())
+
+    def evict(self, conn, keep=None):
+        # Drops least recently used entries until the bodies in objects/
+        # fit in max_bytes, deleting each body no entry refers to any more.
+        # Bodies no entry refers to and that are older than ORPHAN_SECONDS,
+        # such as ones left when an entry was replaced before that was
+        # cleaned up, are deleted first.
+        objects = os.path.join(self.directory, 'objects')
+        cmd = "SELECT DISTINCT digest FROM entries;"
+        used = {x[0] for x in conn.execute(cmd).fetchall()}
+        total = 0
+        for name in os.listdir(objects):
+            with contextlib.suppress(FileNotFoundError):
+                status = os.stat(os.path.join(objects, name))
+                if name in used or \
+                        time.time() - status.st_mtime < ORPHAN_SECONDS:
+                    total += status.st_size
+                else:
+                    os.remove(os.path.join(objects, name))
+        cmd = "SELECT key, digest, size FROM entries ORDER BY used_at;"
+        for key, digest, size in conn.execute(cmd).fetchall():
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            with conn:
+                conn.execute("DELETE FROM entries WHERE key=?;", (key,))
+            if self.remove_unused(conn, digest):
+                total -= size
+
+    def remove_unused(self, conn, digest):
+        # Deletes the body of digest if no entry refers to it.
+        cmd = "SELECT 1 FROM entries WHERE digest=?;"
+        if conn.execute(cmd, (digest,)).fetchone() is not None:
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.directory, 'objects', digest))
+        return True
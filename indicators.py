@@ -0,0 +1,110 @@
+import lazy
+import series_store
+
+np = lazy.LazyModule('numpy')
+
+
+# Per-capita and growth indicators for every (fips, date) of a level,
+# computed for all of its series at once from series_store.read_level's
+# arrays. data_setup stores them in the <level>_indicators tables, which
+# the detail pages and comparison rankings read without joining census
+# themselves.
+INDICATOR_COLUMNS = [('fips', 'TEXT'), ('date', 'TEXT'),
+                     ('cases', 'INTEGER'), ('deaths', 'INTEGER'),
+                     ('new_cases', 'INTEGER'), ('new_deaths', 'INTEGER'),
+                     ('avg_cases', 'REAL'), ('avg_deaths', 'REAL'),
+                     ('cases_per_100k', 'REAL'), ('deaths_per_100k', 'REAL'),
+                     ('avg_cases_per_100k', 'REAL'),
+                     ('doubling_days', 'REAL'), ('cfr', 'REAL'),
+                     ('pop', 'INTEGER'), ('density', 'REAL')]
+DOUBLING_WINDOW_DAYS = 7  # Days over which doubling time is measured.
+# The county level has by far the most rows, so like county_store's tables
+# it is kept as integers: county_indicators_compact holds the values keyed
+# on (county_id, day), leaving out pop and density, which are the same on
+# every row of a county, and the county_indicators view joins fips, date
+# and census back in. Its rows take the county_id of their fips in
+# county_store.FIPS_IDS.
+VALUE_COLUMNS = [x for x in INDICATOR_COLUMNS
+                 if x[0] not in ['fips', 'date', 'pop', 'density']]
+COMPACT_COLUMNS = [('county_id', 'INTEGER'), ('day', 'INTEGER')] + \
+    VALUE_COLUMNS
+COUNTY_VIEW = ("CREATE VIEW county_indicators AS SELECT K.fips, " +
+               "date(I.day*86400,'unixepoch') AS date, " +
+               ','.join('I.' + x for x, y in VALUE_COLUMNS) +
+               ", Cen.pop, Cen.density, I.day " +
+               "FROM county_indicators_compact AS I " +
+               "INNER JOIN county_keys AS K ON K.county_id=I.county_id " +
+               "LEFT JOIN county_census AS Cen ON Cen.county_fips=K.fips;")
+VIEW_SOURCES = ['county_indicators_compact', 'county_keys', 'county_census']
+
+
+def stored_table(level):
+    # The table a level's indicators are stored in, its columns and its
+    # primary key.
+    if level == 'county':
+        return 'county_indicators_compact', COMPACT_COLUMNS, 'county_id, day'
+    return level + '_indicators', INDICATOR_COLUMNS, 'fips, date'
+
+
+def per_100k(values, pop):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(np.where(pop > 0, values * 100000.0 / pop, np.nan), 2)
+
+
+def compute_indicators(fips, columns, starts, census):
+    # Adds the indicator columns to columns, whose rows are grouped by fips
+    # with each group beginning at an index in starts. census maps fips to
+    # (pop, density). Undefined values, such as doubling time while cases
+    # aren't growing, are NaN, which sqlite stores as NULL.
+    size = len(fips)
+    lengths = np.diff(np.r_[starts, size])
+    series_store.derive_columns(columns, starts)
+
+    places = [census.get(str(x), (None, None)) for x in fips[starts]]
+    pop, density = [np.repeat(np.array([np.nan if x[i] is None else x[i]
+                                        for x in places], dtype=float),
+                              lengths)
+                    for i in range(2)]
+    cases, deaths = columns['cases'], columns['deaths']
+    columns['cases_per_100k'] = per_100k(cases, pop)
+    columns['deaths_per_100k'] = per_100k(deaths, pop)
+    columns['avg_cases_per_100k'] = per_100k(columns['avg_cases'], pop)
+
+    # Cases DOUBLING_WINDOW_DAYS rows back in the same series, or 0.
+    back = np.arange(size) - DOUBLING_WINDOW_DAYS
+    earlier = np.where(back >= np.repeat(starts, lengths),
+                       cases[np.maximum(back, 0)], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = cases / earlier
+        columns['doubling_days'] = np.round(np.where(
+            (earlier > 0) & (growth > 1),
+            DOUBLING_WINDOW_DAYS * np.log(2) / np.log(growth), np.nan), 1)
+        columns['cfr'] = np.round(np.where(cases > 0,
+                                           deaths * 100.0 / cases, np.nan), 2)
+    columns['pop'] = pop
+    columns['density'] = density
+    columns['fips'] = fips
+    return columns
+
+
+def add_county_ids(columns, starts, ids):
+    # Adds COMPACT_COLUMNS' keys to columns, grouped as in
+    # compute_indicators, with ids mapping each fips to its county_id.
+    lengths = np.diff(np.r_[starts, len(columns['fips'])])
+    columns['county_id'] = np.repeat(
+        np.array([ids[x] for x in columns['fips'][starts]], dtype=np.int64),
+        lengths)
+    columns['day'] = columns['date'].astype(np.int64)
+    return columns
+
+
+def indicator_rows(columns, start, stop, names=INDICATOR_COLUMNS):
+    # Rows start:stop as tuples in names' order, for executemany.
+    values = list()
+    for column, kind in names:
+        if column == 'date':
+            values.append(np.datetime_as_string(columns['date'][start:stop],
+                                                unit='D').tolist())
+        else:
+            values.append(columns[column][start:stop].tolist())
+    return list(zip(*values))
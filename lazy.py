@@ -0,0 +1,28 @@
+import importlib
+
+
+class LazyModule:
+    # Stands in for a module that is slow to import, importing it the first
+    # time one of its attributes is used, so startup doesn't pay for
+    # numpy, plotly or requests until a request needs them. After that the
+    # module's attributes are copied in and looked up directly. Two threads
+    # that touch it first at once are safe: the import system makes the
+    # second wait for the first.
+
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def __getattr__(self, attribute):
+        if self._lazy_module is None:
+            module = importlib.import_module(self._lazy_name)
+            self.__dict__.update(module.__dict__)
+            self._lazy_module = module
+        return getattr(self._lazy_module, attribute)
+
+
+def load(*modules):
+    # Imports LazyModules now, e.g. before forking workers that should
+    # share them.
+    for module in modules:
+        getattr(module, '__name__')
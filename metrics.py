@@ -0,0 +1,319 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sqlite3
+import threading
+import time
+try:
+    import pyinstrument
+except ImportError:  # Optional; ?profile=pyinstrument falls back to cProfile.
+    pyinstrument = None
+
+
+# METRICS=0 turns all instrumentation off. PROFILE_REQUESTS=1 lets any
+# request add ?profile (or ?profile=pyinstrument) to get a profile of
+# itself back instead of the page; leave it off in production.
+ENABLED = os.environ.get('METRICS', '1') != '0'
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS') == '1'
+INGEST_METRICS_FILE = 'ingest_metrics.prom'
+PROFILE_LINES = 40  # Functions listed in a cProfile report.
+REQUEST_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0]
+METRIC_TYPES = {
+    'covid_request_seconds': ('histogram', 'Request handling time.'),
+    'covid_requests_total': ('counter', 'Requests handled.'),
+    'covid_request_phase_seconds_total': (
+        'counter', 'Request time split into query (SQL), render (templates, '
+        'JSON and compression) and transform (everything else).'),
+    'covid_sql_seconds_total': ('counter', 'Time executing and fetching.'),
+    'covid_sql_statements_total': ('counter', 'Statements executed.'),
+    'covid_sql_rows_total': ('counter', 'Rows fetched.'),
+    'covid_page_cache_entries': ('gauge', 'Pages in the page cache.'),
+    'covid_page_cache_bytes': ('gauge', 'Size of the cached pages.'),
+    'covid_page_cache_hits': ('gauge', 'Page cache hits.'),
+    'covid_page_cache_misses': ('gauge', 'Page cache misses.'),
+    'covid_page_cache_evictions': ('gauge', 'Pages evicted.'),
+    'covid_ingest_stage_seconds': (
+        'gauge', 'Time per stage of the last data_setup run: download, '
+        'parse, insert, index, indicators, rollups, series and geo.'),
+    'covid_ingest_rows': ('gauge', 'Rows parsed by the last run.'),
+    'covid_ingest_run_seconds': ('gauge', 'Length of the last run.'),
+    'covid_ingest_last_run_timestamp_seconds': (
+        'gauge', 'When the last run finished.'),
+}
+
+
+# Metrics are kept per process and read in the Prometheus text format from
+# /metrics. Under several workers each reports its own requests. The ingest
+# runs in another process, so it writes its metrics to INGEST_METRICS_FILE
+# at the end of each run and /metrics appends that file.
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()  # {(name, labels): value}
+        self.histograms = dict()  # {(name, labels): [bucket counts, sum]}
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.histograms.clear()
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, [[0] * (len(REQUEST_BUCKETS) + 1), 0.0])
+            for i, bound in enumerate(REQUEST_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            else:
+                histogram[0][-1] += 1
+            histogram[1] += value
+
+    def render(self):
+        lines = list()
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+        names = sorted({x[0][0] for x in values + histograms})
+        for name in names:
+            kind, text = METRIC_TYPES.get(name, ('untyped', name))
+            lines.append('# HELP ' + name + ' ' + text)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for (metric, labels), value in values:
+                if metric == name:
+                    lines.append(name + format_labels(labels) + ' ' +
+                                 repr(float(value)))
+            for (metric, labels), (counts, total) in histograms:
+                if metric != name:
+                    continue
+                count = 0
+                for bound, bucket in zip(REQUEST_BUCKETS + ['+Inf'], counts):
+                    count += bucket
+                    lines.append(name + '_bucket' +
+                                 format_labels(labels + (('le', str(bound)),))
+                                 + ' ' + str(count))
+                lines.append(name + '_sum' + format_labels(labels) + ' ' +
+                             repr(total))
+                lines.append(name + '_count' + format_labels(labels) + ' ' +
+                             str(count))
+        return ''.join(x + '\n' for x in lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        x + '="' + str(y).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') + '"' for x, y in labels) + '}'
+
+
+registry = Registry()  # This process' requests and SQL.
+ingest = Registry()  # The current data_setup run, reset by each run.
+current = threading.local()  # Phase times of the request on this thread.
+
+
+def render():
+    text = registry.render()
+    try:
+        with open(INGEST_METRICS_FILE) as ingest_file:
+            text += ingest_file.read()
+    except OSError:
+        pass  # No run has finished yet.
+    return text
+
+
+# REQUESTS
+
+def begin_request():
+    current.start = time.perf_counter()
+    current.phases = {'query': 0.0, 'render': 0.0}
+    current.started = dict()
+
+
+def end_request(route, status):
+    phases = getattr(current, 'phases', None)
+    if phases is None:
+        return
+    total = time.perf_counter() - current.start
+    current.phases = None
+    route = route or 'unmatched'
+    registry.observe('covid_request_seconds', total, route=route)
+    registry.add('covid_requests_total', 1, route=route, status=status)
+    phases['transform'] = max(total - phases['query'] - phases['render'], 0.0)
+    for phase, seconds in phases.items():
+        registry.add('covid_request_phase_seconds_total', seconds,
+                     route=route, phase=phase)
+
+
+def start_phase(name):
+    if getattr(current, 'phases', None) is not None:
+        current.started[name] = time.perf_counter()
+
+
+def stop_phase(name):
+    if getattr(current, 'phases', None) is None:
+        return
+    started = current.started.pop(name, None)
+    if started is not None:
+        current.phases[name] += time.perf_counter() - started
+
+
+@contextlib.contextmanager
+def phase(name):
+    start_phase(name)
+    try:
+        yield
+    finally:
+        stop_phase(name)
+
+
+# SQL
+
+def record_sql(statement, seconds, rows=0, executed=0):
+    registry.add('covid_sql_seconds_total', seconds, statement=statement)
+    if executed:
+        registry.add('covid_sql_statements_total', executed,
+                     statement=statement)
+    if rows:
+        registry.add('covid_sql_rows_total', rows, statement=statement)
+    phases = getattr(current, 'phases', None)
+    if phases is not None:
+        phases['query'] += seconds
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Times each statement from execute through its last fetch, since
+    # sqlite does most of the work while rows are being stepped through.
+    # Rows read by iterating over the cursor are neither timed nor counted.
+    statement = ''
+
+    def execute(self, sql, parameters=()):
+        self.statement = ' '.join(sql.split())
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(self.statement, time.perf_counter() - start,
+                       executed=1)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.statement = ' '.join(sql.split())
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(self.statement, time.perf_counter() - start,
+                       executed=1)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        record_sql(self.statement, time.perf_counter() - start,
+                   rows=int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_sql(self.statement, time.perf_counter() - start,
+                   rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        record_sql(self.statement, time.perf_counter() - start,
+                   rows=len(rows))
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute() goes through cursor(), so it is timed too.
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def connection_factory():
+    # For sqlite3.connect(factory=...): timed connections, unless metrics
+    # are off and plain ones cost nothing extra.
+    return TimedConnection if ENABLED else sqlite3.Connection
+
+
+# INGEST
+
+@contextlib.contextmanager
+def stage(name, table=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if ENABLED:
+            labels = {'stage': name}
+            if table is not None:
+                labels['table'] = table
+            ingest.add('covid_ingest_stage_seconds',
+                       time.perf_counter() - start, **labels)
+
+
+def timed_batches(batches, table):
+    # Passes batches through, counting the time spent producing them as
+    # the table's parse stage and their rows as its row count.
+    batches = iter(batches)
+    while True:
+        with stage('parse', table):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        if ENABLED:
+            ingest.add('covid_ingest_rows', len(batch), table=table)
+        yield batch
+
+
+def write_ingest_metrics(seconds):
+    if not ENABLED:
+        return
+    ingest.set('covid_ingest_run_seconds', seconds)
+    ingest.set('covid_ingest_last_run_timestamp_seconds', time.time())
+    with open(INGEST_METRICS_FILE + '.tmp', 'w') as ingest_file:
+        ingest_file.write(ingest.render())
+    os.replace(INGEST_METRICS_FILE + '.tmp', INGEST_METRICS_FILE)
+
+
+# PROFILING
+
+def start_profiler(kind):
+    if kind == 'pyinstrument' and pyinstrument is not None:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler):
+    # Returns (report, mimetype).
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats(
+            'cumulative').print_stats(PROFILE_LINES)
+        return report.getvalue(), 'text/plain'
+    profiler.stop()
+    return profiler.output_html(), 'text/html'
@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import threading
+import traceback
+
+import data_setup
+
+
+# Hours between background runs of data_setup.main_data_setup(). Each run
+# only downloads what is stale, so this can be shorter than the 3 hour
+# COVID_REFRESH_HOURS without refetching anything early.
+REFRESH_INTERVAL_HOURS = float(os.environ.get(
+    'REFRESH_INTERVAL_HOURS', data_setup.COVID_REFRESH_HOURS))
+
+
+def refresh_loop(stop, interval):
+    # New data is built into shadow tables and swapped in, and readers pick
+    # it up through the published data version, so the web server keeps
+    # serving the last good snapshot for the whole run.
+    while not stop.is_set():
+        try:
+            data_setup.main_data_setup()
+        except Exception:  # Keep the old data and try again next time.
+            traceback.print_exc()
+        stop.wait(interval)
+
+
+class RefreshScheduler:
+    # Runs the ingest in its own process so downloads and parsing never
+    # hold the web server's GIL or delay its startup.
+
+    def __init__(self, interval_hours=REFRESH_INTERVAL_HOURS):
+        self.interval = interval_hours * 3600
+        self.stop_event = multiprocessing.Event()
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=refresh_loop, args=(self.stop_event, self.interval),
+            name='refresh-scheduler', daemon=True)
+        self.process.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        if self.process is not None:
+            self.process.join(timeout)
+
+
+if __name__ == "__main__":
+    # The refresh on its own, in the foreground, for servers that run the
+    # app without one, such as gunicorn (see gunicorn.conf.py).
+    refresh_loop(threading.Event(), REFRESH_INTERVAL_HOURS * 3600)
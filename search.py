@@ -0,0 +1,120 @@
+import bisect
+import re
+import threading
+import unicodedata
+
+
+SEARCH_LEVELS = ['state', 'county']
+SEARCH_LIMIT = 10  # Matches returned unless the request asks for more.
+SEARCH_MAX_LIMIT = 50
+BROAD_MATCHES = 64  # Keys a prefix matches before its results are kept.
+# Words too common to be worth matching on their own: 'cou' should not
+# match every county, only the ones whose names start with it.
+SKIP_WORDS = {'county', 'parish', 'borough', 'census', 'area', 'city',
+              'municipality', 'and', 'of', 'the'}
+
+
+# A prefix index over the catalog's state and county names, which are those
+# in state_census and county_census that have data. Each name is entered
+# once under its whole normalized text and once from each later word that
+# isn't in SKIP_WORDS, so 'wash' finds Washtenaw County and 'ann' finds
+# Anne Arundel County. Matches are ranked whole name first, then states
+# before counties, then shorter names, and each entry carries its place's
+# rank as one integer, its score, so ranking is sorting integers. The keys
+# are kept sorted, and a query is the range of keys that start with it,
+# found with bisect. There is one such list for each level and state a
+# search can be limited to, so nothing has to be filtered per match. The
+# ranked results of broad prefixes like 'c', whose ranges hold hundreds of
+# entries, are kept once worked out.
+
+def normalize(text):
+    # Lower case ASCII words, so 'Doña Ana' and 'dona ana' are the same.
+    text = unicodedata.normalize('NFKD', text)
+    text = text.encode('ascii', 'ignore').decode().lower().replace("'", '')
+    return ' '.join(re.findall('[a-z0-9]+', text))
+
+
+class PlaceIndex:
+
+    def __init__(self, catalog):
+        names = catalog['state_names']
+        places = list()  # (level, fips, state fips, name)
+        for fips in catalog['states']:
+            places.append(('state', fips, fips, names[fips]))
+        for state, counties in sorted(catalog['counties'].items()):
+            for fips in counties:
+                name = catalog['county_names'][fips]
+                if state in names:
+                    name += ', ' + names[state]
+                places.append(('county', fips, state, name))
+        self.places = sorted(places, key=lambda x: (
+            SEARCH_LEVELS.index(x[0]), len(x[3]), x[3]))
+
+        # A place's score is its rank, plus len(places) when it matched on
+        # a later word rather than its whole name.
+        entries = dict()  # {(level, state): [(key, score)]}
+        for rank, (level, fips, state, name) in enumerate(self.places):
+            words = normalize(name).split()
+            for i, word in enumerate(words):
+                if i > 0 and word in SKIP_WORDS:
+                    continue
+                entry = (' '.join(words[i:]),
+                         rank + len(self.places) * int(i > 0))
+                for limits in [(None, None), (level, None), (None, state),
+                               (level, state)]:
+                    entries.setdefault(limits, []).append(entry)
+        self.lists = dict()  # {(level, state): (keys, scores)}
+        for limits, pairs in entries.items():
+            pairs.sort()
+            self.lists[limits] = ([x[0] for x in pairs],
+                                  [x[1] for x in pairs])
+        self.broad = dict()  # {(level, state, query): ranked places}
+
+    def ranked(self, scores, limit):
+        places = list()
+        for score in sorted(scores):
+            place = self.places[score % len(self.places)]
+            if place not in places:
+                places.append(place)
+                if len(places) == limit:
+                    break
+        return places
+
+    def search(self, query, limit=SEARCH_LIMIT, level=None, state=None):
+        # The best matches as dicts, limited to a level and to the places
+        # in a state if given.
+        query = normalize(query)
+        keys, scores = self.lists.get((level, state), ([], []))
+        if not query or not keys:
+            return []
+        start = bisect.bisect_left(keys, query)
+        stop = bisect.bisect_left(keys, query + '~', start)  # After z.
+        if stop - start <= BROAD_MATCHES:
+            places = self.ranked(scores[start:stop], limit)
+        else:
+            places = self.broad.get((level, state, query))
+            if places is None:
+                places = self.ranked(scores[start:stop], SEARCH_MAX_LIMIT)
+                self.broad[(level, state, query)] = places
+        return [dict(zip(['level', 'fips', 'state', 'name'], x))
+                for x in places[:limit]]
+
+
+class PlaceSearch:
+    # The PlaceIndex of the current data version, built on first use after
+    # the catalog changes.
+
+    def __init__(self):
+        self.loaded = (None, None)  # (version, index), swapped as one.
+        self.lock = threading.Lock()
+
+    def get(self, catalog, version):
+        loaded_version, index = self.loaded
+        if index is not None and loaded_version == version:
+            return index
+        with self.lock:
+            loaded_version, index = self.loaded
+            if index is None or loaded_version != version:
+                index = PlaceIndex(catalog)
+                self.loaded = (version, index)
+            return index
@@ -0,0 +1,252 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import county_store
+import lazy
+
+np = lazy.LazyModule('numpy')
+
+
+SERIES_CACHE_DIR = 'series_cache'
+SERIES_LEVELS = ['us', 'state', 'county']
+SERIES_COLUMNS = ['cases', 'deaths']
+# Computed from the cumulative columns: new_* is the daily change, avg_*
+# its trailing 7 day mean.
+DERIVED_COLUMNS = ['new_cases', 'new_deaths', 'avg_cases', 'avg_deaths']
+AVERAGE_DAYS = 7
+STORE_FORMAT = 2  # Bumped when the files change, to force a rebuild.
+FETCH_ROWS = 100000  # Rows pulled from sqlite per fetchmany while building.
+
+
+# On disk each level is a directory of .npy columns sorted by (fips, date),
+# plus a <level>.json pointer holding the data version, that directory's
+# name and each fips' [start, stop) offsets into the columns. The pointer
+# is replaced atomically, so readers see either the old or the new build.
+# A series is handed out as a dict of arrays: 'date', SERIES_COLUMNS and
+# DERIVED_COLUMNS.
+
+def derive_columns(columns, starts):
+    # Adds DERIVED_COLUMNS to columns, whose rows are grouped by fips with
+    # each group beginning at an index in starts.
+    size = len(columns['date'])
+    first = np.zeros(size, dtype=bool)
+    first[starts] = True
+    group_start = np.repeat(starts, np.diff(np.r_[starts, size]))
+    rows = np.arange(size)
+    # Each average covers at most AVERAGE_DAYS rows, and none before the
+    # start of its fips.
+    window_start = np.maximum(rows - AVERAGE_DAYS, group_start - 1)
+    for column in SERIES_COLUMNS:
+        new = np.diff(columns[column], prepend=0)
+        new[first] = columns[column][first]
+        total = np.cumsum(new)
+        before = np.where(window_start >= 0, total[window_start], 0)
+        columns['new_' + column] = new
+        columns['avg_' + column] = np.round(
+            (total - before) / (rows - window_start), 2)
+    return columns
+
+
+def level_query(level):
+    # Unordered: a table scan and a sort in numpy beat walking the (fips,
+    # date) index, which visits the table's pages in random order.
+    if level == 'us':
+        return "SELECT '' as fips, date, cases, deaths FROM us;"
+    if level == 'county':
+        return county_store.SERIES_QUERY  # Dates as day numbers.
+    return ("SELECT fips, date, cases, deaths FROM " + level +
+            " WHERE fips<>'';")
+
+
+def read_level(cursor, level):
+    # Every series of a level as (fips, columns, starts): fips and the
+    # 'date' and SERIES_COLUMNS arrays in columns are sorted by (fips,
+    # date), and each fips' rows begin at an index in starts. None when
+    # the level has no rows.
+    fips, dates = list(), list()
+    columns = {x: list() for x in SERIES_COLUMNS}
+    cursor.execute(level_query(level))
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        fips.append(np.array([x[0] for x in rows]))
+        dates.append(np.array([x[1] for x in rows], dtype='datetime64[D]'))
+        for i, column in enumerate(SERIES_COLUMNS, 2):
+            columns[column].append(np.array([x[i] for x in rows],
+                                            dtype=np.int64))
+    if not fips:
+        return None
+
+    dates = np.concatenate(dates)
+    fips = np.concatenate(fips)
+    order = np.lexsort((dates, fips))
+    fips = fips[order]
+    starts = np.flatnonzero(np.r_[True, fips[1:] != fips[:-1]])
+    columns = {x: np.concatenate(columns[x])[order] for x in SERIES_COLUMNS}
+    columns['date'] = dates[order]
+    return fips, columns, starts
+
+
+def group_offsets(keys, starts):
+    # {key: [start, stop]} for rows grouped by key, each group beginning at
+    # an index in starts.
+    stops = np.r_[starts[1:], len(keys)]
+    return {str(key): [int(start), int(stop)]
+            for key, start, stop in zip(keys[starts], starts, stops)}
+
+
+def build_level(cursor, level, version, directory=SERIES_CACHE_DIR):
+    data = read_level(cursor, level)
+    columns, offsets = dict(), dict()
+    if data is not None:
+        fips, columns, starts = data
+        offsets = group_offsets(fips, starts)
+        derive_columns(columns, starts)
+    write_build(level, version, columns, offsets, directory)
+
+
+def write_build(name, version, columns, offsets, directory=SERIES_CACHE_DIR):
+    # Saves columns, a dict of equal length arrays grouped as in offsets,
+    # as a new build of name and then points name's pointer at it.
+    build_name = name + '.' + uuid.uuid4().hex
+    os.makedirs(os.path.join(directory, build_name))
+    for column, values in columns.items():
+        np.save(os.path.join(directory, build_name, column + '.npy'), values)
+
+    pointer = os.path.join(directory, name + '.json')
+    old_build = None
+    if os.path.exists(pointer):
+        with open(pointer) as pointer_file:
+            old_build = json.load(pointer_file)['build']
+    with open(pointer + '.tmp', 'w') as pointer_file:
+        json.dump({'version': version, 'format': STORE_FORMAT,
+                   'build': build_name, 'columns': list(columns),
+                   'offsets': offsets}, pointer_file)
+    os.replace(pointer + '.tmp', pointer)
+    if old_build is not None:
+        # Readers still holding the old maps keep them until they reload.
+        shutil.rmtree(os.path.join(directory, old_build), ignore_errors=True)
+
+
+def stored_version(level, directory=SERIES_CACHE_DIR):
+    try:
+        with open(os.path.join(directory, level + '.json')) as pointer_file:
+            pointer = json.load(pointer_file)
+    except (OSError, ValueError):
+        return None
+    if pointer.get('format') != STORE_FORMAT:
+        return None
+    return pointer['version']
+
+
+def build_series_store(cursor, version, directory=SERIES_CACHE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    for level in SERIES_LEVELS:
+        if stored_version(level, directory) != version:
+            build_level(cursor, level, version, directory)
+
+
+class SeriesStore:
+    # Read side of the cache: memory-maps each level's columns once per data
+    # version and hands out array slices per fips.
+
+    def __init__(self, directory=SERIES_CACHE_DIR):
+        self.directory = directory
+        self.levels = dict()
+        self.lock = threading.Lock()
+
+    def load_level(self, level, version):
+        loaded = self.levels.get(level)
+        if loaded is not None and loaded['version'] == version:
+            return loaded
+        with self.lock:
+            try:
+                with open(os.path.join(self.directory,
+                                       level + '.json')) as pointer_file:
+                    pointer = json.load(pointer_file)
+            except (OSError, ValueError):
+                return None
+            if (pointer['version'] != version
+                    or pointer.get('format') != STORE_FORMAT):
+                return None  # Not rebuilt for this data yet.
+            build = os.path.join(self.directory, pointer['build'])
+            loaded = {'version': version, 'offsets': pointer['offsets']}
+            columns = pointer.get('columns', ['date'] + SERIES_COLUMNS +
+                                  DERIVED_COLUMNS)
+            if pointer['offsets']:
+                for column in columns:
+                    loaded[column] = np.load(
+                        os.path.join(build, column + '.npy'), mmap_mode='r')
+            self.levels[level] = loaded
+            return loaded
+
+    def get(self, level, fips, version):
+        # Returns the series as a dict of arrays, or None when the store
+        # isn't built for this version and the caller should use sqlite.
+        loaded = self.load_level(level, version)
+        if loaded is None:
+            return None
+        if fips not in loaded['offsets']:
+            return empty_series()
+        start, stop = loaded['offsets'][fips]
+        return {x: loaded[x][start:stop]
+                for x in ['date'] + SERIES_COLUMNS + DERIVED_COLUMNS}
+
+    def get_many(self, level, fips_list, version):
+        # Same as get() for several fips at once, as a dict keyed on fips.
+        if self.load_level(level, version) is None:
+            return None
+        return {x: self.get(level, x, version) for x in fips_list}
+
+
+def empty_series():
+    series = {'date': np.array([], dtype='datetime64[D]')}
+    for column in SERIES_COLUMNS + DERIVED_COLUMNS:
+        series[column] = np.array([], dtype=np.int64)
+    return series
+
+
+def query_series(cursor, level, fips):
+    # The sqlite path, used until the store has been rebuilt.
+    if level == 'us':
+        cmd = 'SELECT date,cases,deaths FROM us ORDER BY date;'
+        rows = cursor.execute(cmd).fetchall()
+        if not rows:
+            return empty_series()
+        columns = {'date': np.array([x[0] for x in rows],
+                                    dtype='datetime64[D]'),
+                   'cases': np.array([x[1] for x in rows], dtype=np.int64),
+                   'deaths': np.array([x[2] for x in rows], dtype=np.int64)}
+        return derive_columns(columns, np.array([0]))
+    return query_series_batch(cursor, level, [fips])[fips]
+
+
+def batch_query(level, count):
+    return ('SELECT fips,date,cases,deaths FROM ' + level + ' WHERE fips IN ('
+            + ','.join('?'*count) + ') ORDER BY fips, date;')
+
+
+def query_series_batch(cursor, level, fips_list):
+    # One indexed query for every requested fips, split on the fips
+    # boundaries in a single pass, instead of one query per series.
+    cmd = batch_query(level, len(fips_list))
+    rows = cursor.execute(cmd, tuple(fips_list)).fetchall()
+    series = {x: empty_series() for x in fips_list}
+    if not rows:
+        return series
+
+    fips = np.array([x[0] for x in rows], dtype=str)
+    columns = {'date': np.array([x[1] for x in rows], dtype='datetime64[D]'),
+               'cases': np.array([x[2] for x in rows], dtype=np.int64),
+               'deaths': np.array([x[3] for x in rows], dtype=np.int64)}
+    starts = np.flatnonzero(np.r_[True, fips[1:] != fips[:-1]])
+    derive_columns(columns, starts)
+    stops = np.r_[starts[1:], len(fips)]
+    for start, stop in zip(starts, stops):
+        series[str(fips[start])] = {x: y[start:stop]
+                                    for x, y in columns.items()}
+    return series
@@ -0,0 +1,53 @@
+// Draws each .chart div from the JSON API, so pages only carry the URL of
+// their data and plotly.js is downloaded once and cached.
+function seriesTraces(data, columns) {
+    if (data.series) {  // A comparison: one trace per state or county.
+        return data.series.map(function (series) {
+            return {x: series.dates, y: series.values, name: series.name};
+        });
+    }
+    return columns.map(function (column) {
+        return {x: data.dates, y: data[column],
+                name: column[0].toUpperCase() + column.slice(1)};
+    });
+}
+
+document.querySelectorAll('.chart').forEach(function (div) {
+    fetch(div.dataset.src)
+        .then(function (response) { return response.json(); })
+        .then(function (data) {
+            var layout = {xaxis: {title: {text: 'Date'}},
+                          yaxis: {title: {text: div.dataset.ytitle}}};
+            if (div.dataset.date) {
+                layout.annotations = [{x: div.dataset.date, y: 0, xref: 'x',
+                                       yref: 'y', text: 'Selected Date',
+                                       showarrow: true, arrowhead: 7,
+                                       ax: 0, ay: -10}];
+            }
+            Plotly.newPlot(div, seriesTraces(data,
+                                             div.dataset.columns.split(',')),
+                           layout, {responsive: true});
+        });
+});
+
+// Draws each .map div as a choropleth of one date's cross-section, with
+// the shapes fetched separately so browsers keep them between dates.
+document.querySelectorAll('.map').forEach(function (div) {
+    Promise.all([fetch(div.dataset.geo), fetch(div.dataset.src)])
+        .then(function (responses) {
+            return Promise.all(responses.map(function (response) {
+                return response.json();
+            }));
+        })
+        .then(function (results) {
+            var shapes = results[0], data = results[1];
+            var trace = {type: 'choropleth', geojson: shapes,
+                         locations: data.fips, z: data[div.dataset.metric],
+                         text: data.names, colorscale: 'Reds',
+                         marker: {line: {width: 0.2}},
+                         colorbar: {title: {text: div.dataset.title}}};
+            var layout = {geo: {fitbounds: 'locations', visible: false},
+                          margin: {l: 0, r: 0, t: 0, b: 0}, height: 600};
+            Plotly.newPlot(div, [trace], layout, {responsive: true});
+        });
+});
@@ -0,0 +1,46 @@
+// Turns each input.search into an autocomplete over /api/v1/search: the
+// best matches for what has been typed fill its datalist, and the fips of
+// the one picked goes into the hidden field the form submits. Without a
+// pick, the server takes the best match for the text instead.
+document.querySelectorAll('input.search').forEach(function (input) {
+    var hidden = input.form.elements[input.dataset.target];
+    var list = document.getElementById(input.getAttribute('list'));
+    var results = [];
+    var timer = null;
+
+    function choose() {
+        var picked = results.find(function (result) {
+            return result.name === input.value;
+        });
+        hidden.value = picked ? picked.fips : '';
+    }
+
+    function suggest() {
+        var query = input.value;
+        var params = new URLSearchParams({q: query,
+                                          level: input.dataset.level});
+        if (input.dataset.state) {
+            params.set('state', input.dataset.state);
+        }
+        fetch(input.dataset.src + '?' + params)
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                if (input.value !== query) {
+                    return;  // Typed on since; a newer request is coming.
+                }
+                results = data.results;
+                list.replaceChildren.apply(list, results.map(function (x) {
+                    var option = document.createElement('option');
+                    option.value = x.name;
+                    return option;
+                }));
+                choose();
+            });
+    }
+
+    input.addEventListener('input', function () {
+        choose();
+        clearTimeout(timer);
+        timer = setTimeout(suggest, 100);
+    });
+});
@@ -0,0 +1,8 @@
+# Entry point for multi-process WSGI servers, e.g.
+#   gunicorn --preload --workers 4 wsgi:app
+# Workers fork from this already loaded app and share its memory. The
+# data refresh runs beside them, started by gunicorn.conf.py.
+import final_project
+
+app = final_project.create_app()
+final_project.preload(app)